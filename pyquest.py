@@ -4,34 +4,16 @@ import curses.panel
 import logging
 import sys
 
+from pyquest.control import UserControl
 from pyquest.screen import ChatBox, Screen, StatBox
 from pyquest.engine import GameLoop
 from pyquest.spawn import Player, Mob
-from pyquest.terrain import fill
-from pyquest.util import Counter
+from pyquest.terrain import TerrainCache, fill
+from pyquest.util import Counter, metrics
 from pyquest.zone import Zone
 
 
-class UserControl(object):
-    """Moves the character around the zone"""
-
-    def __init__(self, spawn):
-        self.spawn = spawn
-
-    def accept(self, ch):
-        if ch in (curses.KEY_DOWN, curses.KEY_UP,
-                  curses.KEY_LEFT, curses.KEY_RIGHT):
-            self.move_cardinal(ch)
-        elif ch == ord('a'):
-            self.spawn.attack()
-
-    def move_cardinal(self, key):
-        self.spawn.move_cardinal({
-            curses.KEY_DOWN: 'down',
-            curses.KEY_UP: 'up',
-            curses.KEY_LEFT: 'left',
-            curses.KEY_RIGHT: 'right'
-        }[key])
+WORLD_SEED = 1
 
 
 def init_colors():
@@ -70,8 +52,8 @@ def main(window):
     stat_win = window.subwin(20, 80, 20, 101)
     stat_panel = curses.panel.new_panel(stat_win)
 
-    target_fps = 1 / 60
-    mainloop = GameLoop(target_fps)
+    target_tps = 60
+    mainloop = GameLoop(target_tps)
     user = Player(1, 1, '@', chatbox, mainloop)
     user.level = 2
 
@@ -86,9 +68,10 @@ def main(window):
         mob.level = 1
         zone.add_spawn(mob)
 
-    fill(zone)
+    fill(zone, seed=WORLD_SEED, cache=TerrainCache('cache'))
 
     control = UserControl(user)
+    metrics.enabled = True
 
     fps = Counter()
 
@@ -99,13 +82,15 @@ def main(window):
             control.accept(ch)
         zone.tick()
         statbox.tick()
+        chatbox.tick()
         fps.inc()
-        display_win.refresh()
+        curses.doupdate()
 
     mainloop.repeat(loop)
     mainloop.repeat(
-        lambda: logging.info("Main loop operating at %f fps" % fps.flush()),
-        1 / target_fps
+        lambda: logging.info("Main loop operating at %f fps (%d overruns)" % (
+            fps.flush(), mainloop.overruns)),
+        target_tps
     )
 
     mainloop.run()
@@ -0,0 +1,204 @@
+"""Rough performance measurements. Run with `python -m pyquest.bench`.
+
+Results can be written as JSON with --output so runs from different
+commits can be compared.
+"""
+from __future__ import division
+import argparse
+import json
+import os
+import random
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+from pyquest.bmp import Bitmap, BitmapWriter
+from pyquest.headless import NullScreen, Simulation
+from pyquest.noise import noise
+from pyquest.terrain import generate
+from pyquest.zone import Zone
+
+
+def obstacle_zone(size, density, seed=0):
+    """size x size zone with a fraction density of cells blocked."""
+    rand = random.Random(seed)
+    zone = Zone(size, size, NullScreen())
+    for y, x in zone.cell_iter():
+        if rand.random() < density:
+            zone.set_field(y, x, '=')
+    return zone
+
+
+def bench_route(distances=(5, 10, 20, 40, 80), densities=(0, 0.1, 0.2, 0.3),
+                size=200, trials=20, budget=100000):
+    """Mean route() time by distance and obstacle density."""
+    results = []
+    for density in densities:
+        zone = obstacle_zone(size, density)
+        rand = random.Random(1)
+        center = size // 2
+        for distance in distances:
+            elapsed = 0
+            found = 0
+            for i in xrange(trials):
+                dy = rand.randint(0, distance)
+                dx = distance - dy
+                y2 = center + rand.choice((-1, 1)) * dy
+                x2 = center + rand.choice((-1, 1)) * dx
+                zone.unset_field(center, center)
+                zone.unset_field(y2, x2)
+
+                start = time.time()
+                route = zone.route(center, center, y2, x2, budget)
+                elapsed += time.time() - start
+                if route:
+                    found += 1
+            results.append({
+                'density': density,
+                'distance': distance,
+                'ms_per_route': elapsed / trials * 1000,
+                'routed': found / trials
+            })
+    return results
+
+
+def bench_ticks(size=(200, 200), mobs=(10, 100, 1000), ticks=300, seed=1):
+    """Simulated ticks per second by mob count."""
+    results = []
+    for count in mobs:
+        sim = Simulation(size[0], size[1], seed=seed, mobs=count)
+        start = time.time()
+        sim.run(ticks)
+        elapsed = time.time() - start
+        results.append({
+            'mobs': count,
+            'ticks_per_sec': ticks / elapsed
+        })
+    return results
+
+
+def bench_radius(size=(200, 200), mobs=1000, radius=(3, 10, 30), calls=2000,
+                 seed=1):
+    """targets_in_radius() calls per second by radius."""
+    sim = Simulation(size[0], size[1], seed=seed, mobs=mobs)
+    results = []
+    for r in radius:
+        start = time.time()
+        for i in xrange(calls):
+            sim.mobs[i % mobs].targets_in_radius(r)
+        elapsed = time.time() - start
+        results.append({
+            'radius': r,
+            'calls_per_sec': calls / elapsed
+        })
+    return results
+
+
+def bench_noise(size=200, octaves=6, seed=1):
+    """Noise samples per second, per sample and by grid."""
+    noise_f = noise(octaves, seed=seed)
+    results = []
+
+    class PerSample(object):
+        def __call__(self, y, x):
+            return noise_f(y, x)
+
+    for name, f, n in (('scalar', PerSample(), size // 4),
+                       ('grid', noise_f, size)):
+        start = time.time()
+        generate(n, n, f)
+        elapsed = time.time() - start
+        results.append({
+            'mode': name,
+            'samples_per_sec': n * n / elapsed
+        })
+    return results
+
+
+def bench_bmp(size=500):
+    """Bitmap export throughput in pixels per second, pixel by pixel and
+    streamed a row at a time."""
+    gradient = np.empty((size, size, 3), dtype=np.uint8)
+    gradient[:, :, 0] = np.arange(size)[np.newaxis, :] & 0xff
+    gradient[:, :, 1] = np.arange(size)[:, np.newaxis] & 0xff
+    gradient[:, :, 2] = 0
+
+    def pixels(fname):
+        f = Bitmap(fname, size, size)
+        for y in xrange(size):
+            for x in xrange(size):
+                f.set_pixel(x, y, (x & 0xff, y & 0xff, 0))
+        f.flush()
+        f.close()
+
+    def stream(fname):
+        with BitmapWriter(fname, size, size) as f:
+            f.write_rows(gradient)
+
+    results = []
+    for name, export in (('set_pixel', pixels), ('stream', stream)):
+        fd, fname = tempfile.mkstemp(suffix='.bmp')
+        os.close(fd)
+        try:
+            start = time.time()
+            export(fname)
+            elapsed = time.time() - start
+        finally:
+            os.remove(fname)
+        results.append({
+            'mode': name,
+            'size': size,
+            'pixels_per_sec': size * size / elapsed
+        })
+    return results
+
+
+BENCHMARKS = {
+    'route': bench_route,
+    'ticks': bench_ticks,
+    'radius': bench_radius,
+    'noise': bench_noise,
+    'bmp': bench_bmp
+}
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run, from %s (default: all)' %
+                        ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--output', help='write results as JSON here')
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %s" % name)
+
+    results = {}
+    for name in args.names or sorted(BENCHMARKS):
+        results[name] = BENCHMARKS[name]()
+        for row in results[name]:
+            print name, ' '.join('%s=%s' % (k, ('%.3f' % v)
+                                            if isinstance(v, float) else v)
+                                 for k, v in sorted(row.items()))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'revision': revision(),
+                'time': time.time(),
+                'results': results
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,155 @@
 from __future__ import division
+import mmap
 import struct
-from collections import defaultdict
+
+import numpy as np
+
+
+# magic, file size, offset of the pixel data.
+FILE_HEADER = struct.Struct('<2sI4xI')
+# header size, width, height, planes, bits/pixel, compression, data size,
+# horizontal/vertical resolution, palette colors, important colors.
+DIB_HEADER = struct.Struct('<IiiHHIIiiII')
+HEADER_SIZE = FILE_HEADER.size + DIB_HEADER.size
+
+
+def row_size(width):
+    """Bytes in a row of 24 bit pixels, padded to a multiple of 4."""
+    return (width * 3 + 3) & ~3
+
+
+def headers(width, height, top_down=False):
+    """File and DIB headers for a 24 bit width x height bitmap.
+
+    top_down stores the first row at the top of the image, which lets rows
+    be written in the order they're usually generated.
+    """
+    data_size = row_size(width) * height
+    return FILE_HEADER.pack(
+        "BM",                       # Magic Number
+        HEADER_SIZE + data_size,    # Size of the BMP file
+        HEADER_SIZE                 # Offset where the pixels can be found
+    ) + DIB_HEADER.pack(
+        DIB_HEADER.size,            # The number of bytes in this header
+        width,                      # The width of the bitmap in pixels
+        -height if top_down else height,
+        1,                          # Number of color planes being used
+        24,                         # The number of bits/pixel
+        0,                          # No compression used
+        data_size,                  # The size of the raw BMP data
+        2835, 2835,                 # The horizontal/vertical resolution
+        0,                          # Number of colors in the palette
+        0                           # Means all colors are important
+    )
+
+
+def bgr_row(row, width):
+    """One row of pixels as padded BGR bytes.
+
+    row may be RGB bytes (anything supporting the buffer interface), a
+    NumPy array of width RGB triples or width grey levels, or a sequence
+    of (red, green, blue) tuples.
+    """
+    if isinstance(row, memoryview):
+        # numpy on py2 can't read a memoryview directly.
+        row = row.tobytes()
+    if isinstance(row, (str, bytearray, buffer)):
+        pixels = np.frombuffer(row, dtype=np.uint8).reshape(width, 3)
+    else:
+        pixels = np.asarray(row)
+        if pixels.ndim == 1:
+            pixels = np.repeat(pixels[:, np.newaxis], 3, axis=1)
+        pixels = pixels.astype(np.uint8, copy=False)
+    if pixels.shape != (width, 3):
+        raise ValueError("row of shape %s, expected (%d, 3)" % (
+            pixels.shape, width))
+
+    out = np.zeros(row_size(width), dtype=np.uint8)
+    out[:width * 3] = pixels[:, ::-1].ravel()
+    return out.tostring()
+
+
+class BitmapWriter(object):
+    """Writes a bitmap to disk a row at a time, top row first.
+
+    Only the row being written is ever held in memory.
+    """
+
+    def __init__(self, fname, width, height):
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self.f = open(fname, 'wb')
+        self.f.write(headers(width, height, top_down=True))
+
+    def write_row(self, row):
+        """Append a row. See bgr_row() for what row may be."""
+        if self.rows >= self.height:
+            raise ValueError("bitmap already has %d rows" % self.height)
+        self.f.write(bgr_row(row, self.width))
+        self.rows += 1
+
+    def write_rows(self, rows):
+        """Append each row of rows, e.g. a (n, width, 3) array."""
+        for row in rows:
+            self.write_row(row)
+
+    def close(self):
+        """Finish the file, filling any rows not written with black."""
+        blank = '\0' * row_size(self.width)
+        while self.rows < self.height:
+            self.f.write(blank)
+            self.rows += 1
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MappedBitmap(object):
+    """A bitmap file preallocated on disk and written through an mmap.
+
+    Pixels and blocks can be set in any order; y = 0 is the top row.
+    """
+
+    def __init__(self, fname, width, height):
+        self.width = width
+        self.height = height
+        self.row_size = row_size(width)
+
+        self.f = open(fname, 'w+b')
+        head = headers(width, height, top_down=True)
+        self.f.write(head)
+        self.f.truncate(len(head) + self.row_size * height)
+        self.mm = mmap.mmap(self.f.fileno(), 0)
+
+    def _offset(self, x, y):
+        return HEADER_SIZE + y * self.row_size + x * 3
+
+    def set_pixel(self, x, y, rgb):
+        i = self._offset(x, y)
+        self.mm[i:i + 3] = struct.pack('3B', rgb[2], rgb[1], rgb[0])
+
+    def set_block(self, y, x, pixels):
+        """Copy a (h, w, 3) RGB or (h, w) grey array in at (y, x)."""
+        pixels = np.asarray(pixels)
+        if pixels.ndim == 2:
+            pixels = np.repeat(pixels[:, :, np.newaxis], 3, axis=2)
+        bgr = pixels[:, :, ::-1].astype(np.uint8)
+        for j in xrange(bgr.shape[0]):
+            i = self._offset(x, y + j)
+            self.mm[i:i + bgr.shape[1] * 3] = bgr[j].tostring()
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        self.f.close()
 
 
 class Bitmap(file):
@@ -11,64 +160,27 @@ class Bitmap(file):
         self.height = height
         self.width = width
 
-        self.pixels = defaultdict(lambda: defaultdict(int))
-    
+        self.row_size = row_size(width)
+        self.pixels = bytearray(self.row_size * height)
+
     @property
     def bmp_size(self):
         """Size in bytes of the pixel data"""
-        row_size = self.width * 3
-        return (row_size + (row_size % 4)) * self.height
-
-    def _bmp_header(self):
-        """bitmap header"""
-        return struct.pack('=2si4xi',
-                           "BM",                # Magic Number (unsigned integer 66, 77)
-                           self.bmp_size + 34,  # Size of the BMP file
-                           54                   # The offset where the bitmap data (pixels) can be found.
-                          )
-
-    def _dib_header(self):
-        """device independent header"""
-        return struct.pack('=3i2h6i',
-                           40,                # The number of bytes in the header (from this point).
-                           self.width,       # The width of the bitmap in pixels
-                           self.height,      # The height of the bitmap in pixels
-                           1,                # Number of color planes being used.
-                           24,               # The number of bits/pixel.
-                           0,                # No compression used
-                           self.bmp_size,    # The size of the raw BMP data (after this header)
-                           2835, 2835,       # The horizontal/vertical resolution of the image
-                           0,                # Number of colors in the palette
-                           0                 # Means all colors are important
-                          )
-
-    def _bmp(self):
-        """bitmap data"""
-        b = ''
-        for y in xrange(self.height):
-            for x in xrange(self.width):
-                b += struct.pack('3B',
-                                 self.pixels[x][y][2],
-                                 self.pixels[x][y][1],
-                                 self.pixels[x][y][0])
-            b += struct.pack("%sx" % ((3 * self.width) % 4))
-
-        assert len(b) == self.bmp_size
-        return b
+        return self.row_size * self.height
 
     def set_pixel(self, x, y, rgb):
         """ Set a pixel in the bitmap to the given color
 
             x: pos along the x axis [0, width)
-            y: height along the y axis
+            y: height along the y axis, 0 being the bottom row
             rgb: 3-tuple in the form (red, green, blue)
                 where red green and blue are in the range [0, 255]
         """
-        self.pixels[x][y] = rgb
+        i = y * self.row_size + x * 3
+        self.pixels[i:i + 3] = struct.pack('3B', rgb[2], rgb[1], rgb[0])
 
     def flush(self):
         """Flush image to disk"""
-        self.write(self._bmp_header())
-        self.write(self._dib_header())
-        self.write(self._bmp())
+        self.write(headers(self.width, self.height))
+        self.write(self.pixels)
         file.flush(self)
@@ -0,0 +1,261 @@
+"""Randomized self-checks. Run with `python -m pyquest.check`.
+
+Each check drives a piece of the engine with random input and compares
+what it does against a slow, obviously correct version of the same
+thing, raising CheckFailed at the first difference.
+"""
+from __future__ import division
+import argparse
+import math
+import os
+import random
+import tempfile
+
+from pyquest import snapshot
+from pyquest.engine import GameLoop
+from pyquest.headless import NullChat, Simulation
+from pyquest.serial import pack_spawn, unpack_spawn
+from pyquest.spatial import SpatialHash
+from pyquest.spawn import HATE_FORGET_RADIUS, Mob, Player
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def check_spatial(ops=5000, seed=1):
+    """SpatialHash queries against brute force over every spawn, through
+    random inserts, moves and removes."""
+    rand = random.Random(seed)
+    index = SpatialHash()
+    positions = {}
+
+    def distances(y, x):
+        return sorted(math.sqrt((sy - y) ** 2 + (sx - x) ** 2)
+                      for sy, sx in positions.itervalues())
+
+    for i in xrange(ops):
+        spawn = rand.randrange(ops // 2)
+        op = rand.random()
+        if op < 0.25:
+            index.remove(spawn)
+            positions.pop(spawn, None)
+        elif op < 0.6:
+            y, x = rand.randrange(-600, 600), rand.randrange(-600, 600)
+            if spawn in positions:
+                index.move(spawn, y, x)
+            else:
+                index.insert(spawn, y, x)
+            positions[spawn] = (y, x)
+        else:
+            y, x = rand.randrange(-700, 700), rand.randrange(-700, 700)
+            k = rand.randrange(1, 6)
+            radius = rand.choice((None, 20, 100))
+            want = distances(y, x)
+            if radius is not None:
+                want = [d for d in want if d <= radius]
+            got = [d for d, spawn in index.nearest(y, x, k, radius)]
+            if got != want[:k]:
+                raise CheckFailed("nearest(%d, %d, %d, %s): %s, expected %s"
+                                  % (y, x, k, radius, got, want[:k]))
+
+            r = rand.randrange(0, 50)
+            got = sorted(index.in_radius(y, x, r))
+            want = sorted(s for s, (sy, sx) in positions.iteritems()
+                          if (sy - y) ** 2 + (sx - x) ** 2 <= r * r)
+            if got != want:
+                raise CheckFailed("in_radius(%d, %d, %d) differs" % (y, x, r))
+    return ops
+
+
+class _Recorder(object):
+    """Screen keeping the last thing drawn in each cell."""
+
+    def __init__(self):
+        self.cells = {}
+
+    def update(self, y, x, cell):
+        self.cells[(y, x)] = cell
+
+    def colors_stale(self):
+        return False
+
+    def flush(self):
+        pass
+
+
+def _state(spawn):
+    """What pack_spawn() should carry of spawn, in comparable form."""
+    state = [type(spawn).__name__, spawn.uid, spawn.y, spawn.x,
+             spawn.spawn_point, spawn.facing, spawn.avatar, spawn.level,
+             round(spawn.damage_taken, 3), spawn.attack_rating,
+             spawn.health_rating, spawn.armor_rating, spawn.regen_rate,
+             spawn.wander_radius]
+    if isinstance(spawn, Player):
+        state.append(spawn.experience)
+    if isinstance(spawn, Mob):
+        state += [spawn.kos, spawn.flees, spawn.mobility,
+                  list(spawn.waypoints), spawn.next_waypoint,
+                  # entries that have decayed away are only dropped when
+                  # next looked at, which loading a snapshot does.
+                  sorted((target.uid, round(amount, 3))
+                         for target, amount in spawn.hate.items()
+                         if amount >= 1)]
+    return state
+
+
+def check_snapshot(rounds=5, seed=1):
+    """pack_spawn() and zone snapshots against the state they were taken
+    of, for zones run for a while with random kills and patrols."""
+    rand = random.Random(seed)
+    fd, fname = tempfile.mkstemp(suffix='.snap')
+    os.close(fd)
+    try:
+        for i in xrange(rounds):
+            sim = Simulation(45, 100, seed=rand.randrange(1000), mobs=20)
+            zone = sim.zone
+            for mob in sim.mobs:
+                if rand.random() < 0.3:
+                    mob.mobility = 'waypoint'
+                    mob.waypoints = [(rand.randrange(zone.y),
+                                      rand.randrange(zone.x))
+                                     for j in xrange(rand.randrange(1, 4))]
+                    mob.next_waypoint = rand.randrange(len(mob.waypoints))
+                # hate comes from fights, so only mobs near enough to have
+                # had one get any.
+                if rand.random() < 0.5 and \
+                   mob.distance(sim.player) <= HATE_FORGET_RADIUS:
+                    mob.hate.add(sim.player, rand.randrange(1, 50))
+            sim.run(rand.randrange(1, 300))
+            for mob in rand.sample(sim.mobs, 5):
+                if mob in zone.spawns:
+                    mob.take_damage(sim.player, mob.health_remaining + 1)
+            sim.run(rand.randrange(1, 30))
+
+            pooled = [spawn for batch in zone.respawns.itervalues()
+                      for spawn in batch]
+            for spawn in zone.spawns.keys() + pooled:
+                copy = unpack_spawn(pack_spawn(spawn), None, sim.loop,
+                                    zone.uids.get)
+                if _state(copy) != _state(spawn):
+                    raise CheckFailed("pack_spawn round trip: %s, expected %s"
+                                      % (_state(copy), _state(spawn)))
+
+            snapshot.save(zone, fname, sim.loop)
+            screen = _Recorder()
+            loop = GameLoop()
+            loaded = snapshot.load(fname, screen, NullChat(), loop)
+
+            def spawns(z):
+                return sorted(_state(spawn) for spawn in z.spawns)
+
+            def pool(z):
+                return sorted((due, sorted(spawn.uid for spawn in batch))
+                              for due, batch in z.respawns.iteritems()
+                              if batch)
+
+            if spawns(loaded) != spawns(zone):
+                raise CheckFailed("snapshot changed the spawns")
+            if pool(loaded) != pool(zone):
+                raise CheckFailed("snapshot respawn pool %s, expected %s" %
+                                  (pool(loaded), pool(zone)))
+            if (loaded.ticks, loop.now) != (zone.ticks, sim.loop.now):
+                raise CheckFailed("snapshot changed the tick")
+            field = {}
+            for y, x in zone.cell_iter():
+                cell = zone.get_field(y, x)
+                other = loaded.get_field(y, x)
+                if getattr(cell, 'uid', cell) != getattr(other, 'uid', other):
+                    raise CheckFailed("snapshot cell (%d, %d) differs" %
+                                      (y, x))
+                if other:
+                    field[(y, x)] = other
+            if screen.cells != field:
+                raise CheckFailed("loaded zone drew %d cells, expected %d" %
+                                  (len(screen.cells), len(field)))
+    finally:
+        os.remove(fname)
+    return rounds
+
+
+def check_wheel(ticks=100000, seed=1):
+    """GameLoop fire times against a plain list of when each job is due,
+    through random schedules, repeats, cancels and clock moves."""
+    rand = random.Random(seed)
+    loop = GameLoop()
+    # job -> (next tick due, interval or None, runs left)
+    due = {}
+    timers = {}
+    fired = []
+
+    def job(n):
+        def f():
+            fired.append(n)
+        return f
+
+    for i in xrange(ticks):
+        if rand.random() < 0.05:
+            n = len(timers)
+            delay = rand.choice((0, 1, 2, 255, 256, 257, 1000, 16383,
+                                 16384, 16385, 50000))
+            if rand.random() < 0.3:
+                delay = max(1, delay % 600)
+                runs = [rand.randrange(1, 5)]
+
+                def until(runs=runs):
+                    runs[0] -= 1
+                    return runs[0] == 0
+                timers[n] = loop.repeat(job(n), delay, until)
+                due[n] = (loop.now + delay, delay, runs[0])
+            else:
+                timers[n] = loop.schedule(job(n), delay)
+                due[n] = (loop.now + max(1, delay), None, 1)
+        if due and rand.random() < 0.01:
+            n = rand.choice(due.keys())
+            loop.cancel(timers[n])
+            del due[n]
+        if rand.random() < 0.0005:
+            jump = rand.randrange(1, 1 << 20)
+            loop.set_now(loop.now + jump)
+            due = dict((n, (tick + jump, interval, runs))
+                       for n, (tick, interval, runs) in due.iteritems())
+
+        loop.step()
+        want = sorted(n for n, (tick, interval, runs) in due.iteritems()
+                      if tick == loop.now)
+        if sorted(fired) != want:
+            raise CheckFailed("tick %d ran %s, expected %s" %
+                              (loop.now, sorted(fired), want))
+        del fired[:]
+        for n in want:
+            tick, interval, runs = due.pop(n)
+            if interval is not None and runs > 1:
+                due[n] = (tick + interval, interval, runs - 1)
+    return ticks
+
+
+CHECKS = {
+    'spatial': check_spatial,
+    'snapshot': check_snapshot,
+    'wheel': check_wheel,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('names', nargs='*',
+                        help='checks to run, from %s (default: all)' %
+                        ', '.join(sorted(CHECKS)))
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in CHECKS:
+            parser.error("unknown check %s" % name)
+
+    for name in args.names or sorted(CHECKS):
+        n = CHECKS[name](seed=args.seed)
+        print name, 'ok', n
+
+
+if __name__ == '__main__':
+    main()
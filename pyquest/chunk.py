@@ -0,0 +1,96 @@
+from __future__ import division
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from pyquest.terrain import apply_filter
+
+
+class ChunkProvider(object):
+    """Terrain generated lazily in size x size tiles.
+
+    Tiles are built the first time something asks about a cell inside them
+    and kept in an LRU of at most capacity tiles. With a spill directory,
+    evicted tiles are written there and read back instead of regenerated.
+
+    Tiles sample the same offsets terrain.generate does, so a chunked world
+    is identical to one generated in a single pass.
+    """
+
+    def __init__(self, noise_f, size=64, capacity=64, spill=None,
+                 filter_name='mountains'):
+        self.noise_f = noise_f
+        self.size = size
+        self.capacity = capacity
+        self.spill = spill
+        self.filter_name = filter_name
+        self.tiles = OrderedDict()
+        self.listeners = []
+
+        # accumulated offsets, extended as far as tiles have reached.
+        self._offsets = []
+
+        if spill and not os.path.isdir(spill):
+            os.makedirs(spill)
+
+    def _offsets_for(self, start, count):
+        incr = 0.02
+        off = self._offsets[-1] if self._offsets else 0.0
+        while len(self._offsets) < start + count:
+            off += incr
+            self._offsets.append(off)
+        return self._offsets[start:start + count]
+
+    def _spill_fname(self, cy, cx):
+        return os.path.join(self.spill, 'chunk-%d-%d.npy' % (cy, cx))
+
+    def _build(self, cy, cx):
+        if self.spill:
+            fname = self._spill_fname(cy, cx)
+            if os.path.exists(fname):
+                return np.load(fname)
+
+        yoffs = self._offsets_for(cy * self.size, self.size)
+        xoffs = self._offsets_for(cx * self.size, self.size)
+        field = self.noise_f.grid(xoffs, yoffs).T
+        return apply_filter(self.filter_name, field)
+
+    def _evict(self):
+        (cy, cx), tile = self.tiles.popitem(last=False)
+        if self.spill:
+            fname = self._spill_fname(cy, cx)
+            if not os.path.exists(fname):
+                np.save(fname, tile)
+
+    def chunk(self, cy, cx):
+        """Tile (cy, cx), generating or reloading it if necessary."""
+        key = (cy, cx)
+        tile = self.tiles.pop(key, None)
+        if tile is None:
+            tile = self._build(cy, cx)
+            for listener in self.listeners:
+                listener(cy * self.size, cx * self.size, tile)
+        self.tiles[key] = tile
+
+        while len(self.tiles) > self.capacity:
+            self._evict()
+        return tile
+
+    def value(self, y, x):
+        tile = self.chunk(y // self.size, x // self.size)
+        return tile[y % self.size, x % self.size]
+
+    def get(self, y, x):
+        """Terrain at (y, x) as a field cell: '=' or None."""
+        if self.value(y, x) > 0.25:
+            return '='
+        return None
+
+    def touch(self, y, x, radius=0):
+        """Make sure the tiles within radius of (y, x) are loaded."""
+        size = self.size
+        for cy in xrange(max(0, y - radius) // size, (y + radius) // size + 1):
+            for cx in xrange(max(0, x - radius) // size,
+                             (x + radius) // size + 1):
+                self.chunk(cy, cx)
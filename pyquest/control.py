@@ -0,0 +1,34 @@
+import curses
+
+from pyquest.util import metrics
+
+
+class UserControl(object):
+    """Moves the character around the zone"""
+
+    def __init__(self, spawn):
+        self.spawn = spawn
+
+    def accept(self, ch):
+        if ch in (curses.KEY_DOWN, curses.KEY_UP,
+                  curses.KEY_LEFT, curses.KEY_RIGHT):
+            self.move_cardinal(ch)
+        elif ch == ord('a'):
+            self.spawn.attack()
+        elif ch == ord('p'):
+            self.toggle_profiling()
+
+    def toggle_profiling(self):
+        """Start or stop sampling frame times; stopping dumps them."""
+        if metrics.sampling:
+            metrics.dump('profile.json')
+            metrics.samples.clear()
+        metrics.sampling = not metrics.sampling
+
+    def move_cardinal(self, key):
+        self.spawn.move_cardinal({
+            curses.KEY_DOWN: 'down',
+            curses.KEY_UP: 'up',
+            curses.KEY_LEFT: 'left',
+            curses.KEY_RIGHT: 'right'
+        }[key])
@@ -1,31 +1,167 @@
 from __future__ import division
+import logging
 import time
 
-from sched import scheduler
+from pyquest.util import metrics
+
+
+# wheel level sizes, in bits. level 0 covers the next 256 ticks, each level
+# after that 64 times the one before.
+LEVEL_BITS = (8, 6, 6, 6)
+
+
+class Timer(object):
+    """Handle to a scheduled job. cancel() stops it, repeating or not."""
+
+    __slots__ = ('due', 'f', 'interval', 'until', 'slot', 'cancelled')
+
+    def __init__(self, due, f, interval=None, until=None):
+        self.due = due
+        self.f = f
+        self.interval = interval
+        self.until = until
+        self.slot = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
 
 
 class GameLoop(object):
+    """Runs jobs on integer ticks from a hierarchical timing wheel.
 
-    def __init__(self, target_tps):
+    Scheduling and cancelling are O(1); a job due far in the future moves
+    down a level each time the level below it wraps around.
+    """
 
-        self.target_tps = 60
-        self.scheduler = scheduler(time.time, time.sleep)
+    def __init__(self, target_tps=60):
 
-    def repeat(self, f, n=1, until=None):
-        """repeat f every n ticks."""
+        self.target_tps = target_tps
+        self.now = 0
+        self.overruns = 0
+        self.running = False
+
+        self.levels = [[set() for i in xrange(1 << bits)]
+                       for bits in LEVEL_BITS]
+        self._shifts = []
+        shift = 0
+        for bits in LEVEL_BITS:
+            self._shifts.append(shift)
+            shift += bits
 
-        def _run():
-            f()
-            if not callable(until) or not until():
-                self.repeat(f, n, until)
+    def _add(self, timer):
+        delta = timer.due - self.now
+        for level, shift, bits in zip(self.levels, self._shifts, LEVEL_BITS):
+            if delta < 1 << (shift + bits):
+                slot = level[(timer.due >> shift) & ((1 << bits) - 1)]
+                break
+        else:
+            # beyond the horizon: park it in the last slot of the top level
+            # to be looked at again when that comes round.
+            shift = self._shifts[-1]
+            mask = (1 << LEVEL_BITS[-1]) - 1
+            slot = self.levels[-1][((self.now >> shift) - 1) & mask]
+        timer.slot = slot
+        slot.add(timer)
 
-        self.schedule(_run, n)
+    def _cascade(self):
+        """Move jobs down from the higher levels as the lower ones wrap."""
+        for level, shift, bits in zip(self.levels[1:], self._shifts[1:],
+                                      LEVEL_BITS[1:]):
+            if self.now & ((1 << shift) - 1):
+                return
+            slot = level[(self.now >> shift) & ((1 << bits) - 1)]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self._add(timer)
+
+    def repeat(self, f, n=1, until=None):
+        """repeat f every n ticks, until until() is true after a run."""
+        timer = Timer(self.now + max(1, n), f, max(1, n), until)
+        self._add(timer)
+        return timer
 
     def schedule(self, f, n=1):
-        return self.scheduler.enter(n / self.target_tps, 1, f, ())
+        """run f once, n ticks from now."""
+        timer = Timer(self.now + max(1, n), f)
+        self._add(timer)
+        return timer
+
+    def cancel(self, timer):
+        timer.cancel()
+
+    def set_now(self, tick):
+        """Move the clock to tick, e.g. to carry on from a saved game.
+
+        Jobs already scheduled keep the number of ticks they had left.
+        """
+        timers = []
+        for level in self.levels:
+            for slot in level:
+                timers.extend(slot)
+                slot.clear()
+        for timer in timers:
+            timer.due += tick - self.now
+            timer.slot = None
+        self.now = tick
+        for timer in timers:
+            self._add(timer)
 
-    def cancel(self, event):
-        self.scheduler.cancel(event)
+    def step(self):
+        """Advance one tick and run everything due on it."""
+        self.now += 1
+        self._cascade()
+
+        slot = self.levels[0][self.now & ((1 << LEVEL_BITS[0]) - 1)]
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            timer.slot = None
+        for timer in timers:
+            if timer.cancelled:
+                continue
+            if metrics.enabled:
+                start = metrics.start()
+                timer.f()
+                metrics.stop('loop.callback', start)
+            else:
+                timer.f()
+            if timer.interval is None or timer.cancelled:
+                continue
+            if callable(timer.until) and timer.until():
+                continue
+            timer.due += timer.interval
+            self._add(timer)
+
+        if metrics.enabled:
+            metrics.end_frame(self.now)
+
+    def stop(self):
+        self.running = False
 
     def run(self):
-        self.scheduler.run()
+        """step() target_tps times a second until stop() is called.
+
+        Ticks that take longer than their share of a second are counted
+        in overruns.
+        """
+        budget = 1 / self.target_tps
+        deadline = time.time()
+        self.running = True
+        while self.running:
+            self.step()
+            deadline += budget
+            remaining = deadline - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+            else:
+                self.overruns += 1
+                metrics.counter('loop.overruns').inc()
+                logging.warning("tick %d overran by %.1fms" % (
+                    self.now, -remaining * 1000))
+                # don't try to catch up; start timing afresh from now.
+                deadline = time.time()
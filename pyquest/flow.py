@@ -0,0 +1,56 @@
+from collections import deque
+
+
+# how many steps out from its target a flow field reaches.
+FLOW_RADIUS = 40
+
+
+class FlowField(object):
+    """Breadth-first map of next steps towards a single cell.
+
+    Only terrain blocks the flow; spawns move too often to bake in.
+    """
+
+    def __init__(self, zone, y, x, radius=FLOW_RADIUS):
+        self.origin = (y, x)
+        self.version = zone.terrain_version
+        self.next = {self.origin: None}
+
+        frontier = deque([(self.origin, 0)])
+        while frontier:
+            node, dist = frontier.popleft()
+            if dist >= radius:
+                continue
+            for v in zone.neighbor_iter(*node):
+                if v in self.next or zone.is_blocked(*v):
+                    continue
+                self.next[v] = node
+                frontier.append((v, dist + 1))
+
+
+class FlowFields(object):
+    """One FlowField per chase target, shared by everything chasing it.
+
+    A field is rebuilt only when its target has moved or the zone's terrain
+    has changed since it was built.
+    """
+
+    def __init__(self, zone):
+        self.zone = zone
+        self.fields = {}
+
+    def field(self, target):
+        field = self.fields.get(target)
+        if field is None or \
+           field.origin != (target.y, target.x) or \
+           field.version != self.zone.terrain_version:
+            field = FlowField(self.zone, target.y, target.x)
+            self.fields[target] = field
+        return field
+
+    def next_step(self, target, y, x):
+        """Next cell from (y, x) towards target, or None if out of reach."""
+        return self.field(target).next.get((y, x))
+
+    def discard(self, target):
+        self.fields.pop(target, None)
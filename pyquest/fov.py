@@ -0,0 +1,93 @@
+"""Field of view by recursive shadowcasting."""
+from collections import OrderedDict
+
+
+# (xx, xy, yx, yy) transforms taking octant 0 to each of the eight octants.
+OCTANTS = (
+    (1, 0, 0, 1),
+    (0, 1, 1, 0),
+    (0, -1, 1, 0),
+    (-1, 0, 0, 1),
+    (-1, 0, 0, -1),
+    (0, -1, -1, 0),
+    (0, 1, -1, 0),
+    (1, 0, 0, -1)
+)
+
+
+def shadowcast(is_blocked, y, x, radius):
+    """Cells visible from (y, x) within radius.
+
+    is_blocked(y, x) says whether a cell stops sight. Blocking cells that
+    are seen are included; the origin always is.
+    """
+    visible = set([(y, x)])
+    r2 = radius * radius
+
+    def cast(row, start, end, xx, xy, yx, yy):
+        if start < end:
+            return
+        new_start = start
+        for j in xrange(row, radius + 1):
+            dx = -j - 1
+            dy = -j
+            blocked = False
+            while dx <= 0:
+                dx += 1
+                # slopes of the left and right extremities of this cell.
+                l_slope = (dx - 0.5) / (dy + 0.5)
+                r_slope = (dx + 0.5) / (dy - 0.5)
+                if start < r_slope:
+                    continue
+                elif end > l_slope:
+                    break
+
+                cy = y + dx * yx + dy * yy
+                cx = x + dx * xx + dy * xy
+                if dx * dx + dy * dy <= r2:
+                    visible.add((cy, cx))
+
+                if blocked:
+                    if is_blocked(cy, cx):
+                        new_start = r_slope
+                        continue
+                    blocked = False
+                    start = new_start
+                elif is_blocked(cy, cx) and j < radius:
+                    blocked = True
+                    cast(j + 1, start, l_slope, xx, xy, yx, yy)
+                    new_start = r_slope
+            if blocked:
+                break
+
+    for xx, xy, yx, yy in OCTANTS:
+        cast(1, 1.0, 0.0, xx, xy, yx, yy)
+    return visible
+
+
+class FOVCache(object):
+    """Shadowcast results for a zone, reused until its terrain changes.
+
+    Keyed by (y, x, radius, terrain version), so each mover costs one
+    shadowcast per move however often its view is asked for.
+    """
+
+    def __init__(self, zone, capacity=1024):
+        self.zone = zone
+        self.capacity = capacity
+        self.views = OrderedDict()
+
+    def _is_blocked(self, y, x):
+        zone = self.zone
+        return not zone.in_bounds(y, x) or zone.is_blocked(y, x)
+
+    def visible(self, y, x, radius):
+        """frozenset of cells visible from (y, x)."""
+        key = (y, x, radius, self.zone.terrain_version)
+        view = self.views.pop(key, None)
+        if view is None:
+            view = frozenset(shadowcast(self._is_blocked, y, x, radius))
+            if len(self.views) >= self.capacity:
+                self.views.popitem(last=False)
+        self.views[key] = view
+        return view
@@ -0,0 +1,73 @@
+"""Running the game without a terminal, for benchmarks and servers."""
+from __future__ import division
+import random
+
+from pyquest.engine import GameLoop
+from pyquest.spawn import Player, Mob
+from pyquest.terrain import fill
+from pyquest.zone import Zone
+
+
+class NullScreen(object):
+    """Screen that draws nothing."""
+
+    def update(self, y, x, cell):
+        pass
+
+    def colors_stale(self):
+        return False
+
+    def flush(self):
+        pass
+
+
+class NullChat(object):
+    """ChatBox that only counts what it's sent."""
+
+    def __init__(self):
+        self.count = 0
+
+    def add_message(self, msg):
+        self.count += 1
+
+
+class Simulation(object):
+    """A zone with a player and mobs on a GameLoop, stepped by hand.
+
+    The player stands still and is levelled high enough that the mobs it
+    draws can't kill it.
+    """
+
+    def __init__(self, y=45, x=100, seed=1, mobs=10, player_level=50,
+                 screen=None, chat=None):
+        self.loop = GameLoop()
+        self.chat = chat or NullChat()
+        self.zone = Zone(y, x, screen or NullScreen())
+        fill(self.zone, seed=seed)
+
+        rand = random.Random(seed)
+        self.player = Player(y // 2, x // 2, '@', self.chat, self.loop)
+        self.player.level = player_level
+        self._place(self.player, rand)
+
+        self.mobs = []
+        for i in xrange(mobs):
+            mob = Mob(0, 0, avatar=str(i % 10), chat=self.chat,
+                      scheduler=self.loop)
+            self._place(mob, rand)
+            self.mobs.append(mob)
+
+        self.loop.repeat(self.zone.tick)
+
+    def _place(self, spawn, rand):
+        y, x = spawn.y, spawn.x
+        while self.zone.is_occupied(y, x):
+            y = rand.randrange(self.zone.y)
+            x = rand.randrange(self.zone.x)
+        spawn.y, spawn.x = y, x
+        spawn.spawn_point = (y, x)
+        self.zone.add_spawn(spawn)
+
+    def run(self, ticks):
+        for i in xrange(ticks):
+            self.loop.step()
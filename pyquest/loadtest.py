@@ -0,0 +1,131 @@
+"""Load test for pyquest.server. Run with `python -m pyquest.loadtest`.
+
+Connects clients in steps, each pressing a random key a few times a
+second, and reports the tick rate the server keeps up at each step.
+"""
+from __future__ import division
+import argparse
+import asyncore
+import curses
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from pyquest.server import (FRAME_KEY, FRAME_TICK, KEY, TICK, pack_frame,
+                            unpack_frames)
+
+
+KEYS = (curses.KEY_UP, curses.KEY_DOWN, curses.KEY_LEFT, curses.KEY_RIGHT,
+        ord('a'))
+
+
+class LoadClient(asyncore.dispatcher):
+
+    def __init__(self, host, port, socket_map, keys_per_sec=5):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((host, port))
+        self.inbuf = ''
+        self.outbuf = ''
+        self.received = 0
+        self.ticks = []
+        self.key_interval = 1 / keys_per_sec
+        self.next_key = time.time() + random.random() * self.key_interval
+
+    def press(self, now):
+        if now >= self.next_key:
+            self.next_key = now + self.key_interval
+            self.outbuf += pack_frame(FRAME_KEY, KEY.pack(random.choice(KEYS)))
+
+    def handle_connect(self):
+        pass
+
+    def handle_read(self):
+        data = self.recv(0x10000)
+        self.received += len(data)
+        frames, self.inbuf = unpack_frames(self.inbuf + data)
+        for kind, payload in frames:
+            if kind == FRAME_TICK:
+                self.ticks.append((time.time(), TICK.unpack(payload)[0]))
+
+    def writable(self):
+        return bool(self.outbuf)
+
+    def handle_write(self):
+        sent = self.send(self.outbuf)
+        self.outbuf = self.outbuf[sent:]
+
+    def handle_close(self):
+        self.close()
+
+
+def server_tps(ticks, since):
+    """Server ticks per wall second from TICK frames received after since."""
+    ticks = [t for t in ticks if t[0] >= since]
+    if len(ticks) < 2:
+        return 0.0
+    (t0, n0), (t1, n1) = ticks[0], ticks[-1]
+    return (n1 - n0) / (t1 - t0)
+
+
+def run(host, port, steps, duration, target_tps=60):
+    socket_map = {}
+    clients = []
+    results = []
+    for step in steps:
+        while len(clients) < step:
+            clients.append(LoadClient(host, port, socket_map))
+
+        start = time.time()
+        received = sum(c.received for c in clients)
+        while time.time() - start < duration:
+            now = time.time()
+            for client in clients:
+                client.press(now)
+            asyncore.loop(0.005, False, socket_map, 1)
+
+        live = [c for c in clients if c.connected]
+        tps = server_tps(live[0].ticks, start) if live else 0.0
+        kbps = (sum(c.received for c in clients) - received) / duration / 1024
+        results.append((step, len(live), tps, kbps))
+        print "%8d %8d %8.1f %10.1f" % results[-1]
+        sys.stdout.flush()
+        if tps < target_tps * 0.95:
+            break
+
+    for client in clients:
+        client.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4242)
+    parser.add_argument('--steps', default='1,10,25,50,100,200,400',
+                        help='comma separated client counts')
+    parser.add_argument('--duration', type=float, default=5,
+                        help='seconds to hold each step')
+    parser.add_argument('--spawn-server', action='store_true',
+                        help='start a server on localhost for the test')
+    args = parser.parse_args()
+
+    server = None
+    if args.spawn_server:
+        server = subprocess.Popen([sys.executable, '-m', 'pyquest.server',
+                                   '--port', str(args.port)])
+        time.sleep(2)
+
+    print "%8s %8s %8s %10s" % ('clients', 'live', 'tps', 'KiB/s')
+    try:
+        run(args.host, args.port, [int(s) for s in args.steps.split(',')],
+            args.duration)
+    finally:
+        if server is not None:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,19 @@ from __future__ import division
 import math
 import random
 
+import numpy as np
+
 
 class Perlin(object):
 
-    def __init__(self):
+    def __init__(self, seed=None):
+        """Tables are drawn from a Random seeded with seed, so the same
+        seed always gives the same noise. seed=None picks one at random."""
+
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.seed = seed
+        rand = random.Random(seed)
 
         p = range(0x100 * 2 + 2)
         g2 = []
@@ -21,12 +30,12 @@ class Perlin(object):
 
             g = []
             for j in xrange(2):
-                g.append(((random.randint(0, 0x100 + 0x100 - 1)) - 0x100) / 0x100)
+                g.append(((rand.randint(0, 0x100 + 0x100 - 1)) - 0x100) / 0x100)
             g2[i] = self.normalize(g)
 
         for i in xrange(0xff, -1, -1):
             k = p[i]
-            j = random.randint(0, 0xff)
+            j = rand.randint(0, 0xff)
             p[i] = p[j]
             p[j] = k
 
@@ -35,8 +44,29 @@ class Perlin(object):
             for j in xrange(2):
                 g2[0x100 + i][j] = g2[i][j]
 
-        self.p = p
-        self.g2 = g2
+        self._set_tables(p, g2)
+
+    def _set_tables(self, p, g2):
+        self.p = list(p)
+        self.g2 = [list(g) for g in g2]
+
+        self._p = np.array(p, dtype=np.intp)
+        self._g2 = np.array(g2, dtype=np.float64)
+
+    def save(self, fname):
+        """Write the seed and p/g2 tables to fname (.npz)."""
+        with open(fname, 'wb') as f:
+            np.savez(f, seed=self.seed, p=self._p.astype(np.int16),
+                     g2=self._g2)
+
+    @classmethod
+    def load(cls, fname):
+        """Perlin with the tables stored by save()."""
+        data = np.load(fname)
+        perlin = cls.__new__(cls)
+        perlin.seed = int(data['seed'])
+        perlin._set_tables(data['p'].tolist(), data['g2'].tolist())
+        return perlin
 
     @staticmethod
     def normalize(g):
@@ -99,28 +129,100 @@ class Perlin(object):
 
         return self.lerp(sy, a, b)
 
+    def noise_grid(self, ys, xs):
+        """noise() evaluated over the grid ys x xs in one pass.
+
+        Returns a len(ys) x len(xs) array, element [i][j] being
+        noise(xs[j], ys[i]).
+        """
+        x = np.asarray(xs, dtype=np.float64)[np.newaxis, :]
+        y = np.asarray(ys, dtype=np.float64)[:, np.newaxis]
+        return self._noise_arrays(x, y)
+
+    def _noise_arrays(self, x, y):
+        """Vectorized noise(); x and y must broadcast against each other.
+
+        Mirrors noise() operation for operation so results are identical.
+        """
+
+        def setup(vec):
+            t = vec + 0x1000
+            it = t.astype(np.intp)
+            b0 = it & 0xff
+            b1 = (b0 + 1) & 0xff
+            r0 = t - it
+            r1 = r0 - 1
+            return (b0, b1, r0, r1)
+
+        bx0, bx1, rx0, rx1 = setup(x)
+        by0, by1, ry0, ry1 = setup(y)
+
+        p = self._p
+        i = p[bx0]
+        j = p[bx1]
 
-def noise(n, a=2, b=2):
-    p = Perlin()
-    def _noise(x, y):
+        b00 = p[i + by0]
+        b10 = p[j + by0]
+        b01 = p[i + by1]
+        b11 = p[j + by1]
+
+        # np.power rather than ** so squaring goes through libm pow() like
+        # the scalar scurve; x * x differs from it in the last bit.
+        sx = np.power(rx0, 2.0) * (3 - 2 * rx0)
+        sy = np.power(ry0, 2.0) * (3 - 2 * ry0)
+
+        gx = self._g2[:, 0]
+        gy = self._g2[:, 1]
+
+        def at2(q, rx, ry):
+            return rx * gx[q] + ry * gy[q]
+
+        u = at2(b00, rx0, ry0)
+        v = at2(b10, rx1, ry0)
+        a = u + sx * (v - u)
+
+        u = at2(b01, rx0, ry1)
+        v = at2(b11, rx1, ry1)
+        b = u + sx * (v - u)
+
+        return a + sy * (b - a)
+
+
+class Harmonic(object):
+    """Sum of n octaves of Perlin noise.
+
+    Callable like the closure noise() used to return, and also able to
+    evaluate whole grids with grid().
+    """
+
+    def __init__(self, perlin, n, a=2, b=2):
+        self.perlin = perlin
+        self.n = n
+        self.a = a
+        self.b = b
+
+    def __call__(self, x, y):
+        p, a, b = self.perlin, self.a, self.b
         return sum(
-            [p.noise(b ** i * x, b ** i * y) / (a ** i) for i in xrange(n)]
+            [p.noise(b ** i * x, b ** i * y) / (a ** i) for i in xrange(self.n)]
         )
-    return _noise
 
-def noise_mp(n, a=2, b=2):
-    """Doesn't work because I need to ship around the pn obj."""
-    from multiprocessing import Pool
-    pn = Perlin()
-    def f(i):
-        pn.noise(b ** i * x, b ** i * y) / a ** i
+    def grid(self, ys, xs):
+        """Octave sum over the grid ys x xs.
+
+        Element [i][j] is self(xs[j], ys[i]), as with Perlin.noise_grid.
+        """
+        x = np.asarray(xs, dtype=np.float64)[np.newaxis, :]
+        y = np.asarray(ys, dtype=np.float64)[:, np.newaxis]
+        a, b = self.a, self.b
+        total = np.zeros((y.shape[0], x.shape[1]))
+        for i in xrange(self.n):
+            total += self.perlin._noise_arrays(b ** i * x, b ** i * y) / (a ** i)
+        return total
 
-    def _noise(x, y):
-        p = Pool()
-        print p.map(f, range(n))
-            
-    return _noise
 
+def noise(n, a=2, b=2, seed=None):
+    return Harmonic(Perlin(seed), n, a, b)
 
 def test():
     a = Perlin()
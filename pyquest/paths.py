@@ -0,0 +1,295 @@
+"""Hierarchical pathfinding (HPA*) for routes across a whole zone."""
+import heapq
+import logging
+import os
+from collections import deque
+
+import numpy as np
+
+
+# cells along each side of a cluster.
+CLUSTER_SIZE = 16
+# entrances at least this wide get a node at each end instead of one in
+# the middle.
+WIDE_ENTRANCE = 6
+# default number of graph nodes plan() may expand before giving up.
+PLAN_BUDGET = 2000
+
+
+class PathGraph(object):
+    """Abstract graph of a zone's terrain for planning long routes.
+
+    The zone is cut into square clusters. Where a run of cells along the
+    border between two clusters is open on both sides there's an
+    entrance, with a node on each side of it joined by a step. Nodes in
+    the same cluster are joined by the length of the shortest path
+    between them that stays inside it.
+
+    plan() searches this graph instead of the cells, giving the nodes to
+    make for in turn; the legs between them are short, and are left to
+    Zone.route as they're reached. Like a FlowField, only terrain counts.
+
+    Clusters are built the first time a search reaches them, so only the
+    part of the zone routes actually cross is ever looked at, and when
+    terrain changes only the clusters around the changed cell are dropped,
+    to be built again when next needed.
+    """
+
+    def __init__(self, zone, cluster_size=CLUSTER_SIZE):
+        self.zone = zone
+        self.cluster_size = cluster_size
+        # (cy, cx) -> {node: {node: cost}} for each cluster built, a node
+        # being the cell it's at. Costs include steps across a border.
+        self.clusters = {}
+        # (cy, cx, vertical) -> [(a, b), ...] crossings of the border on
+        # the right of (vertical) or below cluster (cy, cx).
+        self._borders = {}
+
+    def _cluster(self, y, x):
+        return (y // self.cluster_size, x // self.cluster_size)
+
+    def _bounds(self, y, x):
+        """(y0, x0, y1, x1) of the cluster holding (y, x), exclusive."""
+        size = self.cluster_size
+        y0 = y - y % size
+        x0 = x - x % size
+        return (y0, x0,
+                min(y0 + size, self.zone.y), min(x0 + size, self.zone.x))
+
+    def _blocked(self, y, x):
+        """(y0, x0, rows) for the cluster holding (y, x), rows[y - y0][x - x0]
+        saying whether that cell is blocked."""
+        y0, x0, y1, x1 = self._bounds(y, x)
+        return y0, x0, self.zone.blocked_area(y0, x0, y1, x1).tolist()
+
+    def _distances(self, y, x, blocked=None):
+        """Steps from (y, x) to each open cell of its cluster reachable
+        without leaving it. blocked is the cluster's _blocked(), if it's
+        been read already."""
+        y0, x0, rows = blocked or self._blocked(y, x)
+        height = len(rows)
+        width = len(rows[0])
+        dist = {(y, x): 0}
+        frontier = deque([(y, x)])
+        while frontier:
+            node = frontier.popleft()
+            d = dist[node] + 1
+            ny, nx = node
+            for v in ((ny - 1, nx), (ny, nx + 1), (ny + 1, nx), (ny, nx - 1)):
+                if v in dist:
+                    continue
+                ry = v[0] - y0
+                rx = v[1] - x0
+                if 0 <= ry < height and 0 <= rx < width and not rows[ry][rx]:
+                    dist[v] = d
+                    frontier.append(v)
+        return dist
+
+    def _border(self, cy, cx, vertical):
+        """Crossings of the border on the right of (if vertical) or below
+        cluster (cy, cx), as (cell inside, cell outside) pairs."""
+        key = (cy, cx, vertical)
+        crossings = self._borders.get(key)
+        if crossings is not None:
+            return crossings
+
+        size = self.cluster_size
+        zone = self.zone
+        if vertical:
+            border = (cx + 1) * size
+            start, end = cy * size, min((cy + 1) * size, zone.y)
+
+            def cells(i):
+                return (i, border - 1), (i, border)
+        else:
+            border = (cy + 1) * size
+            start, end = cx * size, min((cx + 1) * size, zone.x)
+
+            def cells(i):
+                return (border - 1, i), (border, i)
+
+        crossings = []
+
+        def add(first, last):
+            if last - first >= WIDE_ENTRANCE:
+                crossing = (first, last - 1)
+            else:
+                crossing = ((first + last - 1) // 2,)
+            crossings.extend(cells(i) for i in crossing)
+
+        if border < (zone.x if vertical else zone.y):
+            run = None
+            for i in xrange(start, end):
+                a, b = cells(i)
+                if zone.is_blocked(*a) or zone.is_blocked(*b):
+                    if run is not None:
+                        add(run, i)
+                        run = None
+                elif run is None:
+                    run = i
+            if run is not None:
+                add(run, end)
+        self._borders[key] = crossings
+        return crossings
+
+    def _build(self, cy, cx):
+        """Nodes of cluster (cy, cx) and their edges."""
+        edges = {}
+
+        def cross(crossings, inside):
+            for pair in crossings:
+                a, b = pair if inside == 0 else (pair[1], pair[0])
+                edges.setdefault(a, {})[b] = 1
+
+        cross(self._border(cy, cx, True), 0)
+        cross(self._border(cy, cx, False), 0)
+        if cx > 0:
+            cross(self._border(cy, cx - 1, True), 1)
+        if cy > 0:
+            cross(self._border(cy - 1, cx, False), 1)
+
+        blocked = None
+        for a in edges:
+            blocked = blocked or self._blocked(*a)
+            dist = self._distances(a[0], a[1], blocked)
+            for b in edges:
+                if b != a and b in dist:
+                    edges[a][b] = dist[b]
+        self.clusters[(cy, cx)] = edges
+        return edges
+
+    def _edges(self, y, x):
+        """{node: {node: cost}} of the cluster holding (y, x), building it
+        if it isn't already."""
+        key = self._cluster(y, x)
+        edges = self.clusters.get(key)
+        if edges is None:
+            edges = self._build(*key)
+        return edges
+
+    def build(self):
+        """Build every cluster, e.g. ahead of saving the graph."""
+        size = self.cluster_size
+        for cy in xrange((self.zone.y + size - 1) // size):
+            for cx in xrange((self.zone.x + size - 1) // size):
+                if (cy, cx) not in self.clusters:
+                    self._build(cy, cx)
+
+    def invalidate(self, y, x):
+        """Forget what's known about the terrain around (y, x), after it
+        changes.
+
+        The cluster holding it and the four next to it, whose entrances
+        into it may have moved, are built again when next needed.
+        """
+        cy, cx = self._cluster(y, x)
+        for key in ((cy, cx), (cy - 1, cx), (cy + 1, cx),
+                    (cy, cx - 1), (cy, cx + 1)):
+            self.clusters.pop(key, None)
+        for key in ((cy, cx, True), (cy, cx, False),
+                    (cy, cx - 1, True), (cy - 1, cx, False)):
+            self._borders.pop(key, None)
+
+    def save(self, fname):
+        """Write the clusters built so far to fname (.npz), alongside the
+        terrain they're for."""
+        clusters = np.array(sorted(self.clusters),
+                            dtype=np.int32).reshape(-1, 2)
+        # edges as (y, x) of each end, then cost. Every node has at least
+        # the step across its border, so the edges give all the nodes.
+        edges = np.array([a + b + (cost,)
+                          for targets in self.clusters.itervalues()
+                          for a, costs in targets.iteritems()
+                          for b, cost in costs.iteritems()],
+                         dtype=np.int32).reshape(-1, 5)
+        tmp = fname + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, cluster_size=self.cluster_size,
+                     shape=(self.zone.y, self.zone.x), clusters=clusters,
+                     edges=edges)
+        os.rename(tmp, fname)
+
+    def load(self, fname):
+        """Read clusters save() wrote for the zone's current terrain.
+
+        Returns False, leaving the graph alone, if there's no such file or
+        it was built for a different zone size or cluster size.
+        """
+        if not os.path.exists(fname):
+            return False
+        data = np.load(fname)
+        if 'clusters' not in data.files or \
+           int(data['cluster_size']) != self.cluster_size or \
+           tuple(data['shape']) != (self.zone.y, self.zone.x):
+            return False
+
+        clusters = dict((tuple(key), {}) for key in data['clusters'].tolist())
+        for ay, ax, by, bx, cost in data['edges'].tolist():
+            a = (ay, ax)
+            clusters[self._cluster(ay, ax)].setdefault(a, {})[(by, bx)] = cost
+        self.clusters = clusters
+        self._borders = {}
+        return True
+
+    def _connect(self, y, x):
+        """{node: cost} for the nodes of (y, x)'s cluster it can reach."""
+        dist = self._distances(y, x)
+        return dict((node, dist[node]) for node in self._edges(y, x)
+                    if node in dist)
+
+    def plan(self, y1, x1, y2, x2, budget=PLAN_BUDGET):
+        """Cells to make for in turn to get from (y1, x1) to (y2, x2).
+
+        The list ends with the goal, which may be occupied. Consecutive
+        cells are in the same or neighboring clusters, so each leg is
+        cheap for Zone.route. None if the goal can't be reached, or budget
+        nodes were expanded without reaching it.
+        """
+        goal = (y2, x2)
+        if self._cluster(y1, x1) == self._cluster(y2, x2):
+            return [goal]
+
+        # 'start' and 'goal' stand in for the ends, joined to the graph
+        # only for this search.
+        starts = self._connect(y1, x1)
+        goals = self._connect(y2, x2)
+
+        def h(node):
+            if node == 'goal':
+                return 0
+            return abs(node[0] - y2) + abs(node[1] - x2)
+
+        g = {'start': 0}
+        previous = {'start': None}
+        heap = [(0, 'start')]
+        closed = set()
+        while heap and len(closed) < budget:
+            _, node = heapq.heappop(heap)
+            if node == 'goal':
+                path = []
+                node = previous[node]
+                while node != 'start':
+                    path.append(node)
+                    node = previous[node]
+                path.reverse()
+                path.append(goal)
+                return path
+            if node in closed:
+                continue
+            closed.add(node)
+
+            if node == 'start':
+                neighbors = starts.iteritems()
+            else:
+                neighbors = self._edges(*node)[node].iteritems()
+                if node in goals:
+                    neighbors = list(neighbors) + [('goal', goals[node])]
+            for v, cost in neighbors:
+                cost += g[node]
+                if v not in closed and cost < g.get(v, cost + 1):
+                    g[v] = cost
+                    previous[v] = node
+                    heapq.heappush(heap, (cost + h(v), v))
+
+        logging.debug("no plan (%d, %d) -> (%d, %d)" % (y1, x1, y2, x2))
+        return None
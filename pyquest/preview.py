@@ -0,0 +1,100 @@
+"""Terrain previews as bitmaps. Run with `python -m pyquest.preview`.
+
+The world is generated in square tiles across a process pool, and each
+tile goes straight into a memory-mapped bitmap, so only a few tiles are
+in memory at once however big the world is. --scale n samples every nth
+cell in each direction, for an overview of a world too big to look at.
+"""
+from __future__ import division
+import argparse
+import time
+from multiprocessing import Pool, cpu_count
+
+from pyquest.bmp import MappedBitmap
+from pyquest.noise import noise
+from pyquest.terrain import apply_filter, offsets
+
+
+# cells along each side of a tile, in the output.
+TILE_SIZE = 256
+
+
+_worker_args = None
+
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+
+def _tile(args):
+    y, x = args
+    return y, x, tile(*(_worker_args + (y, x)))
+
+
+def tile(noise_f, filter_name, xoffs, yoffs, y, x, size=TILE_SIZE):
+    """Filtered tile of up to size x size cells with its corner at (y, x).
+
+    xoffs and yoffs are the sample offsets of the whole output, as
+    terrain.offsets() gives them.
+    """
+    field = noise_f.grid(xoffs[x:x + size], yoffs[y:y + size]).T
+    return apply_filter(filter_name, field)
+
+
+def render(fname, y, x, noise_f, filter_name='mountains', scale=1,
+           workers=None):
+    """Write the y x x world noise_f generates to fname as a bitmap.
+
+    With scale > 1 every scale-th cell is sampled, giving a bitmap
+    scale times smaller along each side. Returns its (height, width).
+    """
+    yoffs = offsets(y)[::scale]
+    xoffs = offsets(x)[::scale]
+    height, width = len(yoffs), len(xoffs)
+    corners = [(ty, tx) for ty in xrange(0, height, TILE_SIZE)
+               for tx in xrange(0, width, TILE_SIZE)]
+
+    bmp = MappedBitmap(fname, width, height)
+    try:
+        if not workers or workers < 2:
+            for ty, tx in corners:
+                bmp.set_block(ty, tx, tile(noise_f, filter_name, xoffs,
+                                           yoffs, ty, tx))
+            return height, width
+
+        pool = Pool(workers, _init_worker,
+                    (noise_f, filter_name, xoffs, yoffs))
+        try:
+            for ty, tx, block in pool.imap_unordered(_tile, corners):
+                bmp.set_block(ty, tx, block)
+        finally:
+            pool.close()
+            pool.join()
+        return height, width
+    finally:
+        bmp.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output', nargs='?', default='output.bmp')
+    parser.add_argument('--height', type=int, default=500)
+    parser.add_argument('--width', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--octaves', type=int, default=6)
+    parser.add_argument('--filter', default='mountains')
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=cpu_count())
+    args = parser.parse_args()
+
+    start = time.time()
+    height, width = render(args.output, args.height, args.width,
+                           noise(args.octaves, seed=args.seed), args.filter,
+                           args.scale, args.workers)
+    print "%s: %dx%d in %.1fs" % (args.output, width, height,
+                                  time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,14 @@
 import curses
+import itertools
 import types
+from collections import deque
 
 from pyquest.spawn import Spawn
+from pyquest.util import metrics
+
+
+# how far the player can see.
+VIEW_RADIUS = 20
 
 
 class Screen(object):
@@ -10,6 +17,14 @@ class Screen(object):
     def __init__(self, window, player):
         self.window = window
         self.player = player
+
+        # cells changed since the last flush, (y, x) -> cell.
+        self.dirty = {}
+        # color pair per spawn level, valid for player level _level.
+        self._colors = {}
+        self._level = player.level
+        # cells the player can see; spawns elsewhere aren't drawn.
+        self.visible = None
     
     """
     level:
@@ -44,22 +59,82 @@ class Screen(object):
         elif rating >= 0.75:
             return yellow
 
+    def color_pair(self, n):
+        return curses.color_pair(n)
+
     def update(self, y, x, cell):
-        # TODO: going to have to abstract the cell object.
-        # zone will need to keep track of terrain cells & spawn cells
-        if isinstance(cell, Spawn):
-            con = self.player.con(cell)
-            color = curses.color_pair(self._rating_to_color(con))
-            self.window.addch(y, x, cell.avatar[0], color)
-        elif isinstance(cell, types.StringTypes):
-            self.window.addch(y, x, cell[0])
-        else:
-            raise Exception("unrecognized type %s of cell" % type(cell))
+        """Record a changed cell. Drawn on the next flush()."""
+        self.dirty[(y, x)] = cell
+
+    def colors_stale(self):
+        """True, once, after the player's level changes.
+
+        Every spawn's color depends on it, so they all need redrawing.
+        """
+        if self.player.level == self._level:
+            return False
+        self._level = self.player.level
+        self._colors.clear()
+        return True
+
+    def _color(self, spawn):
+        color = self._colors.get(spawn.level)
+        if color is None:
+            con = self.player.con(spawn)
+            color = self.color_pair(self._rating_to_color(con))
+            self._colors[spawn.level] = color
+        return color
+
+    def _update_view(self):
+        """Follow the player's field of view, redrawing spawns it uncovers
+        or hides."""
+        player = self.player
+        if player.zone is None:
+            return
+        visible = player.zone.visible(player.y, player.x, VIEW_RADIUS)
+        if visible is self.visible:
+            return
+        self.visible = visible
+        # the player moves at most a cell at a time, so anything whose
+        # visibility changed is within a cell of the view.
+        for spawn in player.zone.spawns_in_radius(player.y, player.x,
+                                                  VIEW_RADIUS + 1):
+            self.dirty[(spawn.y, spawn.x)] = spawn
+
+    def _hidden(self, y, x, spawn):
+        return self.visible is not None and spawn is not self.player and \
+            (y, x) not in self.visible
+
+    @metrics.timed('screen.flush')
+    def flush(self):
+        """Draw the dirty cells and stage the window for curses.doupdate()."""
+        self._update_view()
+        for (y, x), cell in self.dirty.iteritems():
+            # TODO: going to have to abstract the cell object.
+            # zone will need to keep track of terrain cells & spawn cells
+            if isinstance(cell, Spawn):
+                if self._hidden(y, x, cell):
+                    self.window.addch(y, x, ' ')
+                else:
+                    self.window.addch(y, x, cell.avatar[0], self._color(cell))
+            elif isinstance(cell, types.StringTypes):
+                self.window.addch(y, x, cell[0])
+            else:
+                raise Exception("unrecognized type %s of cell" % type(cell))
+        self.dirty.clear()
+        self.window.noutrefresh()
 
 
 class ChatBox(object):
+    """Log of the latest max_messages messages.
+
+    A message repeating the one before is folded into it as
+    "msg (x3)". Adding a message only marks the box dirty; tick() redraws
+    it at most once a frame, staged with noutrefresh() for the main
+    loop's doupdate().
+    """
 
-    def __init__(self, panel, hlines, vlines):
+    def __init__(self, panel, hlines, vlines, max_messages=100):
         self.panel = panel
         self.hlines = hlines - 2
         self.vlines = vlines - 2
@@ -67,19 +142,37 @@ class ChatBox(object):
 
         self.panel.show()
         self.window.border(0)
-        self.messages = []
+        self.messages = deque(maxlen=max_messages)
+        self.dirty = False
+
+        # the last message added, and how many times in a row.
+        self._last = None
+        self._repeats = 0
 
     def add_message(self, msg):
-        self.messages.append(msg)
-        self.refresh()
+        if msg == self._last:
+            self._repeats += 1
+            self.messages[-1] = "%s (x%d)" % (msg, self._repeats)
+        else:
+            self._last = msg
+            self._repeats = 1
+            self.messages.append(msg)
+        self.dirty = True
+
+    def tick(self):
+        if self.dirty:
+            self.refresh()
 
+    @metrics.timed('chatbox.refresh')
     def refresh(self):
-        for i, msg in enumerate(self.messages[-self.hlines:]):
+        start = max(0, len(self.messages) - self.hlines)
+        for i, msg in enumerate(itertools.islice(self.messages, start, None)):
             self.window.addnstr(i + 1, 1,
                                 msg.ljust(self.vlines, ' '),
                                 self.vlines)
 
-        self.window.refresh()
+        self.window.noutrefresh()
+        self.dirty = False
 
 
 class StatBox(object):
@@ -102,22 +195,42 @@ class StatBox(object):
         self.panel.show()
         self.window.border(0)
 
+        # the stats last drawn.
+        self.shown = None
+
     def tick(self):
+        """Redraw, if any of the stats shown have changed."""
+        player = self.player
+        stats = (player.health_remaining, player.health_total, player.level,
+                 player.experience, player.experience_needed,
+                 metrics.sampling)
+        # the frame breakdown changes every frame, so while it's on there's
+        # always something new to show.
+        if stats == self.shown and not metrics.sampling:
+            return
+        self.shown = stats
+
         msgs = [
-            "health: %d/%d" % (
-                self.player.health_remaining,
-                self.player.health_total
-            ),
-            "level: %d" % self.player.level,
-            "exp: %d/%d" % (
-                self.player.experience,
-                self.player.experience_needed
-            )
+            "health: %d/%d" % stats[0:2],
+            "level: %d" % stats[2],
+            "exp: %d/%d" % stats[3:5]
         ]
 
+        if metrics.sampling:
+            # where the last frame's time went, biggest first.
+            frame = sorted(metrics.last_frame.items(),
+                           key=lambda item: item[1], reverse=True)
+            msgs.append("")
+            msgs.append("frame: %.2fms" % (
+                sum(t for _, t in frame) * 1000))
+            for name, t in frame[:self.hlines - len(msgs)]:
+                msgs.append("  %s: %.2fms" % (name, t * 1000))
+
+        # blank whatever a longer list left behind.
+        msgs.extend([""] * (self.hlines - len(msgs)))
         for i, msg in enumerate(msgs):
             self.window.addnstr(i + 1, 1,
                                 msg.ljust(self.vlines, ' '),
                                 self.vlines)
 
-        self.window.refresh()
+        self.window.noutrefresh()
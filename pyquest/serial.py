@@ -0,0 +1,102 @@
+"""Compact binary encoding of spawn state, for moving spawns between zones.
+
+Live references (chat, scheduler, zone) aren't encoded; the receiving
+side supplies its own. Mobs' hate lists travel as spawn uids, and their
+patrol waypoints with them.
+"""
+import struct
+
+from pyquest.spawn import Mob, Player, Spawn
+
+
+KINDS = (Spawn, Player, Mob)
+
+# kind, uid, y, x, spawn point y/x, facing y/x, level, damage taken,
+# attack/health/armor ratings, regen rate, wander radius, avatar length.
+SPAWN = struct.Struct('!BQiiiibbHfHHHHHB')
+PLAYER = struct.Struct('!I')
+# kos, flees, mobility, hate entries, waypoints, next waypoint.
+MOB = struct.Struct('!??BHHH')
+HATE = struct.Struct('!Qf')
+WAYPOINT = struct.Struct('!ii')
+
+
+def _kind(spawn):
+    for kind in reversed(xrange(len(KINDS))):
+        if isinstance(spawn, KINDS[kind]):
+            return kind
+    raise TypeError("can't serialize %s" % type(spawn))
+
+
+def pack_spawn(spawn):
+    kind = _kind(spawn)
+    avatar = str(spawn.avatar)
+    parts = [SPAWN.pack(
+        kind, spawn.uid, spawn.y, spawn.x,
+        spawn.spawn_point[0], spawn.spawn_point[1],
+        spawn.facing[0], spawn.facing[1],
+        spawn.level, spawn.damage_taken,
+        spawn.attack_rating, spawn.health_rating, spawn.armor_rating,
+        spawn.regen_rate, spawn.wander_radius, len(avatar)
+    ), avatar]
+
+    if KINDS[kind] is Player:
+        parts.append(PLAYER.pack(spawn.experience))
+    elif KINDS[kind] is Mob:
+        hate = spawn.hate.items()
+        parts.append(MOB.pack(spawn.kos, spawn.flees,
+                              Mob.MOBILITY.index(spawn.mobility), len(hate),
+                              len(spawn.waypoints), spawn.next_waypoint))
+        parts.extend(HATE.pack(target.uid, amount) for target, amount in hate)
+        parts.extend(WAYPOINT.pack(y, x) for y, x in spawn.waypoints)
+    return ''.join(parts)
+
+
+def unpack_spawn(data, chat, scheduler, lookup=None):
+    """Spawn encoded by pack_spawn(), bound to chat and scheduler.
+
+    lookup(uid) resolves hate list entries; ones it can't are dropped.
+    Without a lookup the entries are left pending, for resolve_hate().
+    """
+    (kind, uid, y, x, spawn_y, spawn_x, facing_y, facing_x, level, damage,
+     attack, health, armor, regen, wander, avatar_len) = \
+        SPAWN.unpack_from(data)
+    offset = SPAWN.size
+    avatar = data[offset:offset + avatar_len]
+    offset += avatar_len
+
+    cls = KINDS[kind]
+    spawn = cls(y, x, avatar, chat, scheduler)
+    spawn.uid = uid
+    spawn.spawn_point = (spawn_y, spawn_x)
+    spawn.facing = (facing_y, facing_x)
+    spawn.level = level
+    spawn.damage_taken = damage
+    spawn.attack_rating = attack
+    spawn.health_rating = health
+    spawn.armor_rating = armor
+    spawn.regen_rate = regen
+    spawn.wander_radius = wander
+
+    if cls is Player:
+        spawn.experience, = PLAYER.unpack_from(data, offset)
+    elif cls is Mob:
+        (spawn.kos, spawn.flees, mobility, count, waypoints,
+         spawn.next_waypoint) = MOB.unpack_from(data, offset)
+        spawn.mobility = Mob.MOBILITY[mobility]
+        offset += MOB.size
+        for i in xrange(count):
+            spawn.hate.pending.append(HATE.unpack_from(data, offset))
+            offset += HATE.size
+        for i in xrange(waypoints):
+            spawn.waypoints.append(WAYPOINT.unpack_from(data, offset))
+            offset += WAYPOINT.size
+        if lookup is not None:
+            spawn.hate.resolve(lookup)
+    return spawn
+
+
+def resolve_hate(spawn, lookup):
+    """Swap the uids unpack_spawn() left in a mob's hate list for spawns."""
+    if isinstance(spawn, Mob):
+        spawn.hate.resolve(lookup)
@@ -0,0 +1,325 @@
+"""Multiplayer server. Run with `python -m pyquest.server`.
+
+Clients send key presses; the server runs the zone and sends each client
+only what changed on its screen. Everything travels in frames of a 3 byte
+header (kind, payload length) and a payload:
+
+    CELLS  repeated (y, x, character, color pair)
+    STATS  health remaining, health total, level, experience, needed
+    CHAT   a utf-8 message
+    TICK   the server's tick number, sent once a second of ticks
+    KEY    a curses key code, client to server
+"""
+from __future__ import division
+import argparse
+import asyncore
+import logging
+import random
+import socket
+import struct
+
+from pyquest.control import UserControl
+from pyquest.engine import GameLoop
+from pyquest.screen import Screen
+from pyquest.spawn import Player, Mob, Spawn
+from pyquest.terrain import TerrainCache, fill
+from pyquest.zone import Zone
+
+
+HEADER = struct.Struct('!BH')
+CELL = struct.Struct('!IIBB')
+STATS = struct.Struct('!iiiii')
+TICK = struct.Struct('!I')
+KEY = struct.Struct('!i')
+
+FRAME_CELLS = 1
+FRAME_STATS = 2
+FRAME_CHAT = 3
+FRAME_TICK = 4
+FRAME_KEY = 5
+
+MAX_PAYLOAD = 0xffff
+# bytes handed to the socket per write.
+SEND_SIZE = 0x10000
+
+
+def pack_frame(kind, payload):
+    return HEADER.pack(kind, len(payload)) + payload
+
+
+def unpack_frames(buf):
+    """Complete (kind, payload) frames at the front of buf, and the rest."""
+    frames = []
+    offset = 0
+    while len(buf) - offset >= HEADER.size:
+        kind, length = HEADER.unpack_from(buf, offset)
+        end = offset + HEADER.size + length
+        if end > len(buf):
+            break
+        frames.append((kind, buf[offset + HEADER.size:end]))
+        offset = end
+    return frames, buf[offset:]
+
+
+def pack_cells(cells):
+    """CELLS frames for a dict of (y, x) -> (character, color)."""
+    per_frame = MAX_PAYLOAD // CELL.size
+    items = cells.items()
+    frames = []
+    for i in xrange(0, len(items), per_frame):
+        payload = ''.join(CELL.pack(y, x, ch, color)
+                          for (y, x), (ch, color) in items[i:i + per_frame])
+        frames.append(pack_frame(FRAME_CELLS, payload))
+    return ''.join(frames)
+
+
+class CellBuffer(object):
+    """Stands in for a curses window, keeping what was drawn."""
+
+    def __init__(self):
+        self.cells = {}
+
+    def addch(self, y, x, ch, attr=0):
+        self.cells[(y, x)] = (ord(ch), attr)
+
+    def noutrefresh(self):
+        pass
+
+
+class RemoteScreen(Screen):
+    """A client's view of the zone, drawn into a CellBuffer."""
+
+    def __init__(self, player):
+        super(RemoteScreen, self).__init__(CellBuffer(), player)
+
+    def color_pair(self, n):
+        return n
+
+
+class ZoneScreen(object):
+    """The zone's screen, fanning updates out to every client's."""
+
+    def __init__(self):
+        self.screens = []
+
+    def update(self, y, x, cell):
+        for screen in self.screens:
+            screen.update(y, x, cell)
+
+    def colors_stale(self):
+        # every screen needs asking, so each resets its own state.
+        return any([screen.colors_stale() for screen in self.screens])
+
+    def flush(self):
+        for screen in self.screens:
+            screen.flush()
+
+
+class ClientChat(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def add_message(self, msg):
+        self.messages.append(msg)
+
+
+class BroadcastChat(object):
+    """Chat for mobs: everyone hears it."""
+
+    def __init__(self, server):
+        self.server = server
+
+    def add_message(self, msg):
+        for client in self.server.clients:
+            client.chat.add_message(msg)
+
+
+class RemoteControl(UserControl):
+
+    def toggle_profiling(self):
+        """Clients don't get to profile the server."""
+        pass
+
+
+class NetPlayer(Player):
+
+    __slots__ = ('client',)
+
+    def __init__(self, *args, **kwargs):
+        self.client = kwargs.pop('client')
+        super(NetPlayer, self).__init__(*args, **kwargs)
+
+    def die(self):
+        # Player.die exits the process; here only the client goes.
+        Spawn.die(self)
+        self.zone.remove_spawn(self)
+        self.chat.add_message("You died.")
+        self.client.disconnect_after_send = True
+
+
+class Client(asyncore.dispatcher):
+
+    def __init__(self, sock, server):
+        asyncore.dispatcher.__init__(self, sock, map=server.map)
+        self.server = server
+        self.inbuf = ''
+        self.outbuf = ''
+        self.disconnect_after_send = False
+        self.closed = False
+        self.stats = None
+
+        self.chat = ClientChat()
+        y, x = server.free_cell()
+        self.player = NetPlayer(y, x, '@', self.chat, server.loop, client=self)
+        self.control = RemoteControl(self.player)
+        self.screen = RemoteScreen(self.player)
+
+        server.zone.add_spawn(self.player)
+        server.zone.screen.screens.append(self.screen)
+        server.clients.append(self)
+
+        # everything drawn so far, for a start; chunks loaded later are
+        # drawn as they load.
+        zone = server.zone
+        for y, x, cell in zone.terrain_iter():
+            self.screen.update(y, x, cell)
+        for spawn in zone.spawns:
+            self.screen.update(spawn.y, spawn.x, spawn)
+
+    def handle_read(self):
+        data = self.recv(SEND_SIZE)
+        if not data:
+            return
+        frames, self.inbuf = unpack_frames(self.inbuf + data)
+        for kind, payload in frames:
+            if kind == FRAME_KEY and len(payload) == KEY.size and \
+               self.player.zone is not None:
+                self.control.accept(KEY.unpack(payload)[0])
+
+    def writable(self):
+        return bool(self.outbuf)
+
+    def handle_write(self):
+        sent = self.send(self.outbuf[:SEND_SIZE])
+        self.outbuf = self.outbuf[sent:]
+        if not self.outbuf and self.disconnect_after_send:
+            self.handle_close()
+
+    def queue(self, data):
+        self.outbuf += data
+
+    def send_updates(self, tick=None):
+        """Queue everything that changed for this client since last time."""
+        cells = self.screen.window.cells
+        if cells:
+            self.queue(pack_cells(cells))
+            cells.clear()
+
+        player = self.player
+        # damage is fractional; the frame carries whole numbers.
+        stats = tuple(int(n) for n in (
+            player.health_remaining, player.health_total, player.level,
+            player.experience, player.experience_needed))
+        if stats != self.stats:
+            self.stats = stats
+            self.queue(pack_frame(FRAME_STATS, STATS.pack(*stats)))
+
+        for msg in self.chat.messages:
+            self.queue(pack_frame(FRAME_CHAT,
+                                  msg.encode('utf-8')[:MAX_PAYLOAD]))
+        del self.chat.messages[:]
+
+        if tick is not None:
+            self.queue(pack_frame(FRAME_TICK, TICK.pack(tick)))
+
+        if self.disconnect_after_send and not self.outbuf:
+            self.handle_close()
+
+    def handle_close(self):
+        if self.closed:
+            return
+        self.closed = True
+        server = self.server
+        if self.player.zone is not None and self.player in server.zone.spawns:
+            server.zone.remove_spawn(self.player)
+        server.zone.screen.screens.remove(self.screen)
+        server.clients.remove(self)
+        self.close()
+
+
+class Server(asyncore.dispatcher):
+    """Hosts a zone on a GameLoop and serves it to TCP clients."""
+
+    def __init__(self, host='127.0.0.1', port=4242, y=45, x=100, mobs=10,
+                 seed=1, cache=None, tps=60):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(128)
+
+        self.clients = []
+        self.loop = GameLoop(tps)
+        self.zone = Zone(y, x, ZoneScreen())
+        fill(self.zone, seed=seed, cache=cache)
+
+        self.rand = random.Random(seed)
+        chat = BroadcastChat(self)
+        for i in xrange(mobs):
+            y, x = self.free_cell()
+            mob = Mob(y, x, avatar=str(i % 10), chat=chat,
+                      scheduler=self.loop)
+            self.zone.add_spawn(mob)
+
+        self.loop.repeat(self.tick)
+
+    def free_cell(self):
+        while True:
+            y = self.rand.randrange(self.zone.y)
+            x = self.rand.randrange(self.zone.x)
+            if not self.zone.is_occupied(y, x):
+                return y, x
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, addr = pair
+        logging.info("client connected from %s:%d" % addr)
+        Client(sock, self)
+
+    def tick(self):
+        asyncore.loop(0, False, self.map, 1)
+        self.zone.tick()
+
+        now = self.loop.now
+        tick = now if now % self.loop.target_tps == 0 else None
+        for client in list(self.clients):
+            client.send_updates(tick)
+
+    def run(self):
+        self.loop.run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4242)
+    parser.add_argument('--height', type=int, default=45)
+    parser.add_argument('--width', type=int, default=100)
+    parser.add_argument('--mobs', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    server = Server(args.host, args.port, args.height, args.width, args.mobs,
+                    args.seed, TerrainCache('cache'))
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""Versioned binary snapshots of a whole zone.
+
+    header
+    terrain layer       one byte per cell
+    occupancy layer     one bit per cell
+    spawn layer         little-endian uint32 spawn id per cell
+    spawn table         (id, length, pack_spawn() bytes) per spawn
+    respawn pool        (due tick, length, pack_spawn() bytes) per dead
+                        spawn waiting to respawn
+
+The layers are copied out of an mmap of the file in bulk; only the spawn
+table and respawn pool are parsed, a record per spawn. Pending scheduled
+actions aren't kept, only the tick the scheduler had reached.
+
+Only zones with all their terrain in their own layers can be saved;
+chunked zones, whose terrain comes from a ChunkProvider, can't.
+"""
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from pyquest.serial import pack_spawn, resolve_hate, unpack_spawn
+from pyquest.zone import Zone
+
+
+MAGIC = 'PQZS'
+VERSION = 4
+
+# magic, version, height, width, tick, terrain version, spawn count,
+# zone tick, respawn pool size.
+HEADER = struct.Struct('<4sHIIQQIQI')
+RECORD = struct.Struct('<IH')
+POOLED = struct.Struct('<QH')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _spawn_layer_bytes(zone):
+    layer = zone.spawn_layer
+    if sys.byteorder == 'big':
+        layer = array('I', layer)
+        layer.byteswap()
+    return layer.tostring()
+
+
+def save(zone, fname, scheduler=None):
+    """Write zone to fname, replacing any existing file atomically."""
+    if zone.terrain is not None:
+        raise SnapshotError("can't snapshot a zone with chunked terrain")
+    tick = scheduler.now if scheduler is not None else 0
+    records = []
+    for spawn, sid in zone.spawn_ids.iteritems():
+        data = pack_spawn(spawn)
+        records.append(RECORD.pack(sid, len(data)) + data)
+    pooled = []
+    for due, batch in zone.respawns.iteritems():
+        for spawn in batch:
+            data = pack_spawn(spawn)
+            pooled.append(POOLED.pack(due, len(data)) + data)
+
+    tmp = fname + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, zone.y, zone.x, tick,
+                                zone.terrain_version, len(records),
+                                zone.ticks, len(pooled)))
+            f.write(zone.terrain_layer)
+            f.write(zone.occupied.bits)
+            f.write(_spawn_layer_bytes(zone))
+            f.write(''.join(records))
+            f.write(''.join(pooled))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, fname)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def load(fname, screen, chat, scheduler):
+    """Zone stored in fname, drawing to screen.
+
+    Spawns are bound to chat and scheduler, and the scheduler is moved on
+    to the tick the snapshot was taken at. Pooled dead spawns go back in
+    the zone's respawn pool, due on the same zone tick as before.
+    """
+    with open(fname, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if mm.size() < HEADER.size:
+            raise SnapshotError("%s is too short to be a snapshot" % fname)
+        magic, version = HEADER.unpack_from(mm)[:2]
+        if magic != MAGIC:
+            raise SnapshotError("%s is not a zone snapshot" % fname)
+        if version != VERSION:
+            raise SnapshotError("%s is snapshot version %d, not %d" % (
+                fname, version, VERSION))
+        (magic, version, y, x, tick, terrain_version, count, ticks,
+         pool_size) = HEADER.unpack_from(mm)
+
+        zone = Zone(y, x, screen)
+        cells = y * x
+        offset = HEADER.size
+        zone.terrain_layer = bytearray(mm[offset:offset + cells])
+        offset += cells
+        nbytes = len(zone.occupied.bits)
+        zone.occupied.bits = bytearray(mm[offset:offset + nbytes])
+        offset += nbytes
+        layer = array('I')
+        layer.fromstring(mm[offset:offset + cells * layer.itemsize])
+        if sys.byteorder == 'big':
+            layer.byteswap()
+        zone.spawn_layer = layer
+        offset += cells * layer.itemsize
+
+        spawns = {}
+        for i in xrange(count):
+            sid, length = RECORD.unpack_from(mm, offset)
+            offset += RECORD.size
+            spawns[sid] = unpack_spawn(mm[offset:offset + length], chat,
+                                       scheduler)
+            offset += length
+
+        pooled = []
+        for i in xrange(pool_size):
+            due, length = POOLED.unpack_from(mm, offset)
+            offset += POOLED.size
+            pooled.append((due, unpack_spawn(mm[offset:offset + length],
+                                             chat, scheduler)))
+            offset += length
+    finally:
+        mm.close()
+
+    zone.terrain_version = terrain_version
+    zone.ticks = ticks
+    if scheduler is not None:
+        scheduler.set_now(tick)
+
+    table_size = max(spawns) + 1 if spawns else 1
+    zone.spawn_table = [None] * table_size
+    zone._free_ids = [sid for sid in xrange(1, table_size)
+                      if sid not in spawns]
+    for sid, spawn in spawns.iteritems():
+        spawn.set_zone(zone)
+        zone.spawn_table[sid] = spawn
+        zone.spawn_ids[spawn] = sid
+        zone.spawns[spawn] = (spawn.y, spawn.x)
+        zone.uids[spawn.uid] = spawn
+        if spawn.is_user():
+            zone.users.add(spawn)
+        zone.index.insert(spawn, spawn.y, spawn.x)
+        zone._adopt(spawn)
+    for due, spawn in pooled:
+        # its stats wait, inactive, in the zone's table, as despawn() leaves
+        # them.
+        spawn.move_stats(zone.stats)
+        zone.respawns[due].append(spawn)
+    for spawn in spawns.itervalues():
+        resolve_hate(spawn, zone.uids.get)
+    for due, spawn in pooled:
+        resolve_hate(spawn, zone.uids.get)
+    for spawn in spawns.itervalues():
+        zone._sense(spawn, None, (spawn.y, spawn.x))
+
+    # the layers were filled in behind the screen's back.
+    for y, x, cell in zone.terrain_iter():
+        screen.update(y, x, cell)
+    for spawn in spawns.itervalues():
+        screen.update(spawn.y, spawn.x, spawn)
+    return zone
@@ -0,0 +1,126 @@
+from __future__ import division
+import heapq
+import math
+from collections import defaultdict
+
+
+class SpatialHash(object):
+    """Uniform bucket grid of spawns for radius and nearest queries.
+
+    Queries only look at the buckets overlapping the search area, so their
+    cost follows the number of spawns nearby rather than the area covered.
+    """
+
+    def __init__(self, cell_size=8):
+        self.cell_size = cell_size
+        self.buckets = defaultdict(set)
+        self.positions = {}
+        # (ky0, kx0, ky1, kx1) spanning every key ever filled since the
+        # index was last empty, so nearest() knows when to stop without
+        # looking at every bucket. Never shrinks otherwise, which only
+        # makes an unbounded search look a little further.
+        self._bounds = None
+
+    def _key(self, y, x):
+        return (y // self.cell_size, x // self.cell_size)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def insert(self, spawn, y, x):
+        self.positions[spawn] = (y, x)
+        ky, kx = key = self._key(y, x)
+        self.buckets[key].add(spawn)
+        bounds = self._bounds
+        if bounds is None:
+            self._bounds = (ky, kx, ky, kx)
+        elif not (bounds[0] <= ky <= bounds[2] and
+                  bounds[1] <= kx <= bounds[3]):
+            self._bounds = (min(bounds[0], ky), min(bounds[1], kx),
+                            max(bounds[2], ky), max(bounds[3], kx))
+
+    def remove(self, spawn):
+        pos = self.positions.pop(spawn, None)
+        if pos is None:
+            return
+        key = self._key(*pos)
+        bucket = self.buckets[key]
+        bucket.discard(spawn)
+        if not bucket:
+            del self.buckets[key]
+        if not self.positions:
+            self._bounds = None
+
+    def move(self, spawn, y, x):
+        old = self.positions.get(spawn)
+        if old is not None and self._key(*old) == self._key(y, x):
+            self.positions[spawn] = (y, x)
+            return
+        self.remove(spawn)
+        self.insert(spawn, y, x)
+
+    def _ring(self, ky, kx, ring):
+        """Bucket keys at chebyshev distance ring from (ky, kx)."""
+        if ring == 0:
+            yield (ky, kx)
+            return
+        for kx1 in xrange(kx - ring, kx + ring + 1):
+            yield (ky - ring, kx1)
+            yield (ky + ring, kx1)
+        for ky1 in xrange(ky - ring + 1, ky + ring):
+            yield (ky1, kx - ring)
+            yield (ky1, kx + ring)
+
+    def in_radius(self, y, x, r):
+        """Spawns within euclidean distance r of (y, x)."""
+        r2 = r * r
+        ky0, kx0 = self._key(y - r, x - r)
+        ky1, kx1 = self._key(y + r, x + r)
+        found = []
+        buckets = self.buckets
+        positions = self.positions
+        for ky in xrange(ky0, ky1 + 1):
+            for kx in xrange(kx0, kx1 + 1):
+                bucket = buckets.get((ky, kx))
+                if not bucket:
+                    continue
+                for spawn in bucket:
+                    sy, sx = positions[spawn]
+                    if (sy - y) ** 2 + (sx - x) ** 2 <= r2:
+                        found.append(spawn)
+        return found
+
+    def nearest(self, y, x, k=1, radius=None, accept=None):
+        """Up to k (distance, spawn) pairs nearest (y, x), closest first.
+
+        radius bounds the search; accept, if given, filters candidates.
+        """
+        if not self.positions:
+            return []
+
+        ky, kx = self._key(y, x)
+        if radius is None:
+            # far enough to reach every bucket.
+            ky0, kx0, ky1, kx1 = self._bounds
+            max_ring = max(ky - ky0, ky1 - ky, kx - kx0, kx1 - kx, 0)
+        else:
+            max_ring = int(math.ceil(radius / self.cell_size)) + 1
+
+        best = []
+        for ring in xrange(max_ring + 1):
+            for key in self._ring(ky, kx, ring):
+                for spawn in self.buckets.get(key, ()):
+                    if accept is not None and not accept(spawn):
+                        continue
+                    sy, sx = self.positions[spawn]
+                    d = math.sqrt((sy - y) ** 2 + (sx - x) ** 2)
+                    if radius is not None and d > radius:
+                        continue
+                    best.append((d, spawn))
+            if len(best) >= k:
+                best = heapq.nsmallest(k, best, key=lambda item: item[0])
+                # anything in a further ring is at least this far away.
+                if best[-1][0] <= ring * self.cell_size:
+                    break
+        best.sort(key=lambda item: item[0])
+        return best[:k]
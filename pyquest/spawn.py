@@ -1,9 +1,13 @@
 from __future__ import division
+import itertools
 import logging
+import os
 import random
 import sys
+from collections import deque
 
-from collections import defaultdict
+from pyquest.stats import Stat, StatTable
+from pyquest.util import metrics
 
 
 DIRECTIONS = {
@@ -14,11 +18,148 @@ DIRECTIONS = {
 }
 
 
+# how near a kos mob notices users.
+AGGRO_RADIUS = 3
+# hate for targets further away than this fades, by HATE_DECAY a tick.
+HATE_FADE_RADIUS = 5
+HATE_DECAY = 0.99
+# targets further away than this are forgotten.
+HATE_FORGET_RADIUS = 20
+
+# ticks a dead mob waits before respawning.
+RESPAWN_DELAY = 600
+
+
+_uids = itertools.count(1)
+
+
+def next_uid():
+    """Id unique across the zone processes on a machine."""
+    return ((os.getpid() & 0xffffffff) << 32) | (next(_uids) & 0xffffffff)
+
+
+class Hate(object):
+    """A mob's hate list, decaying lazily.
+
+    Each entry holds an amount as of a tick and whether it was fading
+    then, so the amount at any later tick is worked out when asked for
+    instead of decayed every tick. The zone tells the mob when it or a
+    target moves, and the entry is re-based from then.
+    """
+
+    def __init__(self, mob):
+        self.mob = mob
+        # target: (amount, tick, fading)
+        self.entries = {}
+        # (uid, amount) pairs waiting on resolve().
+        self.pending = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __contains__(self, target):
+        return target in self.entries
+
+    def _fading(self, target):
+        mob = self.mob
+        return mob.zone is not None and \
+            mob.distance(target) > HATE_FADE_RADIUS
+
+    def get(self, target):
+        amount, since, fading = self.entries[target]
+        if fading:
+            amount *= HATE_DECAY ** (self.mob.scheduler.now - since)
+        return amount
+
+    def items(self):
+        return [(target, self.get(target)) for target in self.entries]
+
+    def set(self, target, amount):
+        if target not in self.entries:
+            target.haters.add(self.mob)
+        self.entries[target] = (amount, self.mob.scheduler.now,
+                                self._fading(target))
+
+    def add(self, target, amount):
+        if target in self.entries:
+            amount += self.get(target)
+        self.set(target, amount)
+
+    def at_least(self, target, amount):
+        if target not in self.entries or self.get(target) < amount:
+            self.set(target, amount)
+
+    def forget(self, target):
+        if self.entries.pop(target, None) is not None:
+            target.haters.discard(self.mob)
+
+    def clear(self):
+        for target in self.entries.keys():
+            self.forget(target)
+
+    def rebase(self, target):
+        """Restart target's entry from now, after it or the mob moved."""
+        mob = self.mob
+        amount = self.get(target)
+        if amount < 1 or target.zone is not mob.zone or \
+           mob.distance(target) > HATE_FORGET_RADIUS:
+            self.forget(target)
+            return
+        self.set(target, amount)
+
+    def strongest(self):
+        """Most hated target, forgetting any that have run out."""
+        best = None
+        most = 0
+        for target in self.entries.keys():
+            amount = self.get(target)
+            if amount < 1 or target.is_dead() or \
+               target.zone is not self.mob.zone:
+                self.forget(target)
+            elif amount > most:
+                best = target
+                most = amount
+        return best
+
+    def resolve(self, lookup):
+        """Add the pending entries whose uids lookup(uid) can find."""
+        for uid, amount in self.pending:
+            target = lookup(uid)
+            if target is not None:
+                self.set(target, amount)
+        del self.pending[:]
+
+
 class Spawn(object):
     """MOB & Users"""
 
+    __slots__ = ('uid', 'spawn_point', 'y', 'x', 'avatar', 'chat',
+                 'scheduler', 'zone', 'facing', 'wander_radius',
+                 'scheduled_events', 'haters', 'respawn', 'stats',
+                 'stats_row')
+
+    # users within this distance are sense()d.
+    aggro_radius = 0
+
+    # numeric state lives in the zone's StatTable while in a zone, so it
+    # can be updated for every spawn at once.
+    level = Stat('level')
+    damage_taken = Stat('damage_taken')
+    regen_rate = Stat('regen_rate')
+    attack_rating = Stat('attack_rating')
+    health_rating = Stat('health_rating')
+    armor_rating = Stat('armor_rating')
+
     def __init__(self, y, x, avatar, chat, scheduler):
         logging.debug("spawning %s" % avatar)
+        # a table of its own, until a zone takes it in.
+        self.stats = StatTable(1)
+        self.stats_row = self.stats.add()
+
+        self.uid = next_uid()
         self.spawn_point = (y, x)
         self.y = y
         self.x = x
@@ -39,16 +180,11 @@ class Spawn(object):
         # would be better to replace this with a do_unless wrapper.
         self.scheduled_events = {}
 
-        # TODO: is_dead schedule helper
-        self.scheduler.repeat(
-            self.regenerate,
-            self.regenerate_delay,
-            until=self.is_dead
-        )
-        self.scheduler.repeat(
-            self.tick,
-            until=self.is_dead
-        )
+        # mobs with this spawn on their hate list.
+        self.haters = set()
+
+        # ticks after dying to respawn, or None to stay dead.
+        self.respawn = None
 
     def is_user(self):
         return False
@@ -93,13 +229,17 @@ class Spawn(object):
 
         if not target:
             target = self.get_facing()
-        if not target:
+        if not isinstance(target, Spawn):
+            # nothing there, or terrain.
             return
 
         def do_attack():
+            if target.zone is not self.zone:
+                # it's died or left since.
+                return
             base_damage = self.attack_rating * self.level
             mitigation = target.armor / 2
-            self.chat.add_message("mit: %s, base: %s" % (mitigation, base_damage))
+            logging.debug("mit: %s, base: %s" % (mitigation, base_damage))
             target.take_damage(self, max(0, base_damage - mitigation))
 
         self.schedule_action(
@@ -111,13 +251,27 @@ class Spawn(object):
     def die(self):
         pass
 
+    def reset(self):
+        """Back to full health at spawn_point, ready to respawn."""
+        self.cancel_actions()
+        self.damage_taken = 0
+        self.y, self.x = self.spawn_point
+        self.facing = DIRECTIONS['right']
+
+    def cancel_actions(self):
+        """Cancel everything schedule_action() has pending."""
+        for event in self.scheduled_events.values():
+            self.scheduler.cancel(event)
+        self.scheduled_events.clear()
+
     def schedule_action(self, key, event, ticks):
         if key in self.scheduled_events:
             return
 
         def _inner():
             event()
-            del self.scheduled_events[key]
+            # the event may have cleared it already, e.g. by leaving the zone.
+            self.scheduled_events.pop(key, None)
 
         self.scheduled_events[key] = self.scheduler.schedule(_inner, ticks)
 
@@ -146,31 +300,62 @@ class Spawn(object):
     # distance methods. Do these belong here, or in zone?
 
     def nearest_target(self, spawns):
-        enemies = [(spawn, spawn.x + spawn.y) for spawn in spawns]
-        return min(enemies, key=lambda x: x[1])[0]
+        return min(spawns, key=self.distance)
     
     def distance(self, target):
         return self.zone.distance(self.y, self.x, target.y, target.x)
 
     def targets_in_radius(self, radius):
-        # TODO: move to Zone?
-        return [self.zone.get_field(*loc) for loc
-                in self.zone.circle_iter(self.y, self.x, radius)
-                if self.zone.has_spawn(*loc)]
+        return self.zone.spawns_in_radius(self.y, self.x, radius, exclude=self)
+
+    def can_see(self, target, radius):
+        return (target.y, target.x) in self.zone.visible(self.y, self.x, radius)
+
+    def move_stats(self, table):
+        """Keep this spawn's stats in a row of table from now on.
+
+        Returns the row, which is left as it was if already in table.
+        """
+        if table is self.stats:
+            return self.stats_row
+        row = table.add()
+        table.copy(row, self.stats, self.stats_row)
+        self.stats.release(self.stats_row)
+        self.stats = table
+        self.stats_row = row
+        return row
+
+    def update(self):
+        """Called by the zone while alive: every tick near users, less
+        often further away.
+
+        Regeneration isn't done here but for every spawn at once, by the
+        zone's StatTable.
+        """
+        self.tick()
 
-    def regenerate(self):
-        if self.health_remaining == self.health_total:
-            return
+    def tick(self):
+        pass
 
-        regen = min(self.regen_rate, self.health_total - self.health_remaining)
-        self.damage_taken -= regen
+    # proximity triggers, raised by the zone.
 
-    def tick(self):
+    def moved(self):
+        """This spawn arrived in or moved within its zone."""
+        pass
+
+    def removed(self):
+        """This spawn is leaving its zone."""
+        pass
+
+    def sense(self, user, inside):
+        """user moved, and is now inside (or just left) aggro_radius."""
         pass
 
 
 class Player(Spawn):
 
+    __slots__ = ('experience',)
+
     def __init__(self, *args, **kwargs):
         super(Player, self).__init__(*args, **kwargs)
 
@@ -212,15 +397,32 @@ class Player(Spawn):
 
 class Mob(Spawn):
 
+    __slots__ = ('hate', 'nearby', 'kos', 'flees', 'mobility', 'waypoints',
+                 'next_waypoint', 'course', 'leg')
+
     MOBILITY = ('wander', 'waypoint', 'stationary')
 
     def __init__(self, y, x, avatar='M', *args, **kwargs):
         super(Mob, self).__init__(y, x, avatar, *args, **kwargs)
 
-        self.hate = defaultdict(int)
+        self.hate = Hate(self)
+        # users within aggro_radius.
+        self.nearby = set()
         self.kos = True
         self.flees = False
         self.mobility = 'wander'
+        self.respawn = RESPAWN_DELAY
+
+        # cells patrolled in turn with the 'waypoint' mobility.
+        self.waypoints = []
+        self.next_waypoint = 0
+        # see head_for().
+        self.course = None
+        self.leg = None
+
+    @property
+    def aggro_radius(self):
+        return AGGRO_RADIUS if self.kos else 0
 
     @property
     def exp(self):
@@ -236,13 +438,19 @@ class Mob(Spawn):
             target.add_experience(self.exp)
             self.die()
             return
-        self.hate[target] += dmg
+        self.hate.add(target, dmg)
 
     def die(self):
-        for event in self.scheduled_events.values():
-            self.scheduler.cancel(event)
+        self.cancel_actions()
+        self.zone.despawn(self)
 
-        self.zone.remove_spawn(self)
+    def reset(self):
+        super(Mob, self).reset()
+        self.hate.clear()
+        self.nearby.clear()
+        self.next_waypoint = 0
+        self.course = None
+        self.leg = None
 
     def flee(self):
         target = self.nearest_target(self.hate)
@@ -256,17 +464,21 @@ class Mob(Spawn):
             self.move_to(new_y, self.x)
 
     def chase(self, target):
-        # TODO: doesn't avoid obstacles.
         if self.can_hit(target):
             self.attack(target)
-        else:
+            return
+
+        # the shared flow field only knows about terrain. route around
+        # anything else in the way.
+        next_cell = self.zone.flow.next_step(target, self.y, self.x)
+        if next_cell is None or self.zone.is_occupied(*next_cell):
             route = self.zone.route(self.y, self.x, target.y, target.x)
             if not route:
                 logging.info("no route to target")
                 return
             assert len(route) > 1
             next_cell = route[1]
-            self.move_to(next_cell[0], next_cell[1])
+        self.move_to(next_cell[0], next_cell[1])
 
     def wander(self):
         distance_to_spawn = self.zone.distance(
@@ -290,10 +502,83 @@ class Mob(Spawn):
             60
         )
 
+    def head_for(self, y, x):
+        """Take the next step on the way to (y, x), however far off.
+
+        The course there is planned once over the zone's PathGraph, and
+        each leg of it turned into steps with Zone.route when it's
+        reached, so a step costs about the same wherever (y, x) is.
+        Returns False if there's no way there.
+        """
+        zone = self.zone
+        here = (self.y, self.x)
+        if not self.course or self.course[-1] != (y, x):
+            course = zone.paths.plan(self.y, self.x, y, x)
+            if course is None:
+                return False
+            self.course = deque(course)
+            self.leg = deque()
+
+        # drop the step just taken, and any part of the course reached.
+        if self.leg and self.leg[0] == here:
+            self.leg.popleft()
+        while self.course and self.course[0] == here:
+            self.course.popleft()
+        if not self.course:
+            return True
+
+        step = self.leg[0] if self.leg else None
+        if step is None or zone.is_occupied(*step) or \
+           zone.distance(self.y, self.x, step[0], step[1]) != 1:
+            # off the leg, or something's in the way: find a new one.
+            if len(self.course) > 1 and zone.is_occupied(*self.course[0]):
+                self.course.popleft()
+            target = self.course[0]
+            route = zone.route(self.y, self.x, target[0], target[1])
+            if route is None:
+                # plan afresh from wherever this is, next time.
+                self.course = None
+                return False
+            self.leg = deque(route[1:])
+            step = self.leg[0]
+        self.move_to(step[0], step[1])
+        return True
+
     def waypoint(self):
-        # TODO
-        pass
+        """Patrol the waypoints in turn, round and round."""
+        if not self.waypoints:
+            return
+        y, x = self.waypoints[self.next_waypoint]
+        arrived = (self.y, self.x) == (y, x) or \
+            (self.zone.is_occupied(y, x) and
+             self.zone.distance(self.y, self.x, y, x) == 1)
+        if arrived or not self.head_for(y, x):
+            self.next_waypoint = (self.next_waypoint + 1) % len(self.waypoints)
+            self.course = None
+
+    def moved(self):
+        for target in self.hate.entries.keys():
+            self.hate.rebase(target)
+
+    def removed(self):
+        self.hate.clear()
+        self.nearby.clear()
+
+    def sense(self, user, inside):
+        if inside:
+            self.nearby.add(user)
+        else:
+            self.nearby.discard(user)
+        self.aggro()
 
+    def aggro(self):
+        """Hate the nearest user in aggro_radius that can be seen."""
+        radius = self.aggro_radius
+        targets = [t for t in self.nearby if self.can_see(t, radius)]
+        if len(targets):
+            self.hate.at_least(self.nearest_target(targets), 2)
+
+    @metrics.timed('mob.tick')
     def tick(self):
         super(Mob, self).tick()
 
@@ -303,38 +588,11 @@ class Mob(Spawn):
             if self.flees and \
                self.health_total * 0.1 >= self.health_remaining:
                 self.flee()
-            elif len(self.hate):
-                self.chase(
-                    max(self.hate.items(), key=lambda x: x[1])[0]
-                )
-            else:
-                if self.mobility == 'wander':
-                    self.wander()
-                elif self.mobility == 'waypoint':
-                    self.waypoint()
-
-        if self.kos:
-            targets = self.targets_in_radius(3)
-            targets = [t for t in targets if t.is_user()]
-            if len(targets):
-                self.hate[self.nearest_target(targets)] = 2
-
-        forget = set()
-        for spawn in self.hate:
-            # slowely forget hate
-            if self.distance(spawn) > 5:
-                self.hate[spawn] *= 0.99
-
-            # remove distant targets on hate list
-            if self.distance(spawn) > 20:
-                forget.add(spawn)
-
-            # remove spawns with no hate left
-            if self.hate[spawn] < 1:
-                forget.add(spawn)
-
-            if spawn.is_dead():
-                forget.add(spawn)
-
-        for spawn in forget:
-            del self.hate[spawn]
+                return
+            target = self.hate.strongest()
+            if target is not None:
+                self.chase(target)
+            elif self.mobility == 'wander':
+                self.wander()
+            elif self.mobility == 'waypoint':
+                self.waypoint()
@@ -0,0 +1,98 @@
+from __future__ import division
+
+import numpy as np
+
+
+# numeric spawn state, one array per column.
+COLUMNS = (
+    ('level', np.int32),
+    ('damage_taken', np.float64),
+    ('regen_rate', np.int32),
+    ('attack_rating', np.int32),
+    ('health_rating', np.int32),
+    ('armor_rating', np.int32),
+    # regenerate on tick regen_next, then every regen_delay ticks.
+    ('regen_delay', np.int32),
+    ('regen_next', np.int64),
+)
+NAMES = tuple(name for name, dtype in COLUMNS)
+
+
+class StatTable(object):
+    """Spawn stats stored column-wise, a row per spawn.
+
+    A zone keeps its spawns' stats in one table so per-tick updates such
+    as regeneration run as a single vectorized pass. Only active rows
+    are updated; rows are reused once released.
+    """
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        # rows handed out so far, free or not.
+        self.rows = 0
+        self.active = np.zeros(capacity, dtype=bool)
+        for name, dtype in COLUMNS:
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+        self._free = []
+
+    def _grow(self):
+        capacity = self.capacity * 2
+        for name in ('active',) + NAMES:
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.capacity] = old
+            setattr(self, name, new)
+        self.capacity = capacity
+
+    def add(self):
+        """A new, inactive row."""
+        if self._free:
+            return self._free.pop()
+        if self.rows == self.capacity:
+            self._grow()
+        self.rows += 1
+        return self.rows - 1
+
+    def release(self, row):
+        self.active[row] = False
+        self._free.append(row)
+
+    def copy(self, row, other, other_row):
+        """Set row to other_row of the StatTable other."""
+        for name in NAMES:
+            getattr(self, name)[row] = getattr(other, name)[other_row]
+
+    def regenerate(self, tick):
+        """Heal every active row that's due to regenerate on tick."""
+        n = self.rows
+        due = self.regen_next[:n] == tick
+        due &= self.active[:n]
+        if not due.any():
+            return
+        damage = self.damage_taken[:n]
+        damage[due] = np.maximum(damage[due] - self.regen_rate[:n][due], 0)
+        self.regen_next[:n][due] += self.regen_delay[:n][due]
+
+    def alive(self):
+        """Mask of the rows with health remaining, as Spawn.is_dead() sees
+        it."""
+        n = self.rows
+        return self.health_rating[:n] * self.level[:n] - \
+            self.damage_taken[:n] >= 1
+
+
+class Stat(object):
+    """Spawn attribute kept in a column of the spawn's StatTable."""
+
+    __slots__ = ('column',)
+
+    def __init__(self, column):
+        self.column = column
+
+    def __get__(self, spawn, cls):
+        if spawn is None:
+            return self
+        return getattr(spawn.stats, self.column).item(spawn.stats_row)
+
+    def __set__(self, spawn, value):
+        getattr(spawn.stats, self.column)[spawn.stats_row] = value
@@ -1,8 +1,71 @@
 from __future__ import division
-from noise import Perlin, noise
+import os
+from multiprocessing import Pool
 
+import numpy as np
+
+from noise import Harmonic, Perlin, noise
+
+
+# rows handed to a worker at a time by generate()
+BAND_ROWS = 32
+
+
+def offsets(n, incr=0.02):
+    """Accumulated sample offsets, as generate() walks them."""
+    off = 0.0
+    result = []
+    for i in xrange(n):
+        off += incr
+        result.append(off)
+    return result
+
+
+_worker_noise = None
+
+
+def _init_worker(noise_f):
+    global _worker_noise
+    _worker_noise = noise_f
+
+
+def _band(args):
+    start, xoffs, yoffs = args
+    return start, _grid(_worker_noise, xoffs, yoffs)
+
+
+def _grid(noise_f, xoffs, yoffs):
+    # noise_f(yoff, xoff) puts yoff on the noise's x axis, hence the
+    # swapped arguments and the transpose.
+    return noise_f.grid(xoffs, yoffs).T
+
+
+def generate(y, x, noise_f, workers=None):
+    """y x x grid of noise_f samples.
+
+    With workers > 1 (and a noise_f that supports grid()) row bands are
+    computed across a process pool. The noise object is pickled to each
+    worker once, so every worker samples the same tables and the result
+    is identical to the serial one.
+    """
+    if hasattr(noise_f, 'grid'):
+        xoffs = offsets(x)
+        yoffs = offsets(y)
+        if not workers or workers < 2:
+            return _grid(noise_f, xoffs, yoffs)
+
+        rows = np.empty((y, x))
+        bands = [(i, xoffs, yoffs[i:i + BAND_ROWS])
+                 for i in xrange(0, y, BAND_ROWS)]
+        pool = Pool(workers, _init_worker, (noise_f,))
+        try:
+            for start, band in pool.imap_unordered(_band, bands):
+                rows[start:start + band.shape[0]] = band
+        finally:
+            pool.close()
+            pool.join()
+        return rows
 
-def generate(y, x, noise_f):
     incr = 0.02
     yoff = 0.0
     rows = []
@@ -17,41 +80,93 @@ def generate(y, x, noise_f):
     return rows
 
 
+# each works on a single cell or elementwise on an array of them.
 FILTERS = {
-    'mountains': lambda cell: 255 if cell > 0.25 else 0,
+    'mountains': lambda cell: np.where(cell > 0.25, 255, 0),
     'clouds': lambda cell: (cell * 127) + 127
 }
 
-def fill(zone):
-    noise_f = noise(6)
-    bg = generate(zone.y, zone.x, noise_f)
 
-    for y, row in enumerate(bg):
-        for x, col in enumerate(row):
-            val = FILTERS['mountains'](col)
-            if val > 0.25:
-                zone.set_field(y, x, '=')
+def apply_filter(name, field):
+    """FILTERS[name] over a whole height field, as a uint8 array."""
+    return np.asarray(FILTERS[name](np.asarray(field)), dtype=np.uint8)
+
+
+class TerrainCache(object):
+    """Filtered height fields on disk, keyed by what generated them.
+
+    Fields are stored as raw uint8 .npy files and memory-mapped when read
+    back, so a cached world costs a file open rather than a noise pass.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _fname(self, seed, octaves, y, x, filter_name):
+        return os.path.join(
+            self.path,
+            'terrain-%d-%d-%dx%d-%s.npy' % (seed, octaves, y, x, filter_name))
+
+    def get(self, seed, octaves, y, x, filter_name):
+        """Read-only memory map of the field, or None if not cached."""
+        fname = self._fname(seed, octaves, y, x, filter_name)
+        if not os.path.exists(fname):
+            return None
+        return np.load(fname, mmap_mode='r')
+
+    def put(self, seed, octaves, filter_name, field):
+        y, x = field.shape
+        fname = self._fname(seed, octaves, y, x, filter_name)
+        tmp = fname + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, np.asarray(field, dtype=np.uint8))
+        os.rename(tmp, fname)
+
+    def paths(self, seed, octaves, zone):
+        """Load zone.paths for the terrain fill() gave it, or build and
+        save it if it hasn't been before."""
+        fname = os.path.join(
+            self.path,
+            'paths-%d-%d-%dx%d.npz' % (seed, octaves, zone.y, zone.x))
+        if not zone.paths.load(fname):
+            zone.paths.build()
+            zone.paths.save(fname)
+
+    def perlin(self, seed):
+        """Perlin for seed, loading its tables if they've been saved."""
+        fname = os.path.join(self.path, 'perlin-%d.npz' % seed)
+        if os.path.exists(fname):
+            return Perlin.load(fname)
+        perlin = Perlin(seed)
+        perlin.save(fname)
+        return perlin
+
 
+def heights(y, x, seed=None, octaves=6, filter_name='mountains',
+            cache=None, workers=None):
+    """Filtered y x x height field, from cache when possible."""
+    if cache is not None and seed is not None:
+        field = cache.get(seed, octaves, y, x, filter_name)
+        if field is not None:
+            return field
+        noise_f = Harmonic(cache.perlin(seed), octaves)
+    else:
+        noise_f = noise(octaves, seed=seed)
 
-if __name__ == '__main__':
-    from bmp import Bitmap
-    size = 500
-    
-    def rgb(x):
-        return (x, x, x)
+    field = apply_filter(filter_name, generate(y, x, noise_f, workers))
+    if cache is not None and seed is not None:
+        cache.put(seed, octaves, filter_name, field)
+    return field
 
-    f = Bitmap('output.bmp', size, size)
 
-    perlin = Perlin()
-    pnoise_harmonic = noise(6)
-    pnoise = perlin.noise
+def fill(zone, seed=None, octaves=6, cache=None, workers=None):
+    field = heights(zone.y, zone.x, seed, octaves, 'mountains', cache, workers)
 
-    n = generate(size, size, pnoise_harmonic)
+    for y, x in zip(*np.nonzero(field > 0.25)):
+        zone.set_field(int(y), int(x), '=')
 
-    for y, row in enumerate(n):
-        for x, col in enumerate(row):
-            val = FILTERS['mountains'](col)
-            f.set_pixel(y, x, rgb(val))
+    if cache is not None and seed is not None:
+        cache.paths(seed, octaves, zone)
 
-    f.flush()
-    f.close()
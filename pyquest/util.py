@@ -1,3 +1,10 @@
+from __future__ import division
+import functools
+import json
+from collections import defaultdict, deque
+from timeit import default_timer as clock
+
+
 class Counter(object):
 
     def __init__(self):
@@ -10,3 +17,175 @@ class Counter(object):
         tmp = self.count
         self.count = 0
         return tmp
+
+
+class Bitset(object):
+    """Fixed-size set of bits over a bytearray."""
+
+    def __init__(self, size):
+        self.size = size
+        self.bits = bytearray((size + 7) >> 3)
+
+    def test(self, i):
+        return bool(self.bits[i >> 3] & (1 << (i & 7)))
+
+    def set(self, i):
+        self.bits[i >> 3] |= 1 << (i & 7)
+
+    def clear(self, i):
+        self.bits[i >> 3] &= ~(1 << (i & 7)) & 0xff
+
+
+class SparseBitset(object):
+    """Bitset holding only the bits that are set, for fields too big to
+    give a bit per cell."""
+
+    def __init__(self):
+        self.members = set()
+
+    def test(self, i):
+        return i in self.members
+
+    def set(self, i):
+        self.members.add(i)
+
+    def clear(self, i):
+        self.members.discard(i)
+
+
+class SparseLayer(dict):
+    """Flat layer holding only its non-zero cells; any other reads as 0."""
+
+    def __missing__(self, i):
+        return 0
+
+    def __setitem__(self, i, value):
+        if value:
+            dict.__setitem__(self, i, value)
+        else:
+            self.pop(i, None)
+
+
+class Gauge(object):
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(object):
+    """Latencies in power-of-two microsecond buckets."""
+
+    def __init__(self):
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[int(seconds * 1e6).bit_length()] += 1
+
+    def percentile(self, p):
+        """Upper bound, in seconds, of the bucket holding the pth percentile."""
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= self.count * p / 100:
+                return (1 << bucket) / 1e6
+        return 0.0
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max
+        }
+
+
+class Metrics(object):
+    """Registry of named counters, gauges and latency histograms.
+
+    Functions wrapped with timed() record their latency while enabled.
+    With sampling on, each frame's time is also broken down by subsystem
+    (self time, so nested timings aren't counted twice) and kept in
+    samples until dumped.
+    """
+
+    def __init__(self, max_samples=3600):
+        self.enabled = False
+        self.sampling = False
+        self.counters = defaultdict(Counter)
+        self.gauges = defaultdict(Gauge)
+        self.histograms = defaultdict(Histogram)
+
+        self.frame = defaultdict(float)
+        self.last_frame = {}
+        self.samples = deque(maxlen=max_samples)
+        self._stack = []
+
+    def counter(self, name):
+        return self.counters[name]
+
+    def gauge(self, name):
+        return self.gauges[name]
+
+    def histogram(self, name):
+        return self.histograms[name]
+
+    def start(self):
+        self._stack.append(0.0)
+        return clock()
+
+    def stop(self, name, start):
+        elapsed = clock() - start
+        children = self._stack.pop()
+        if self._stack:
+            self._stack[-1] += elapsed
+        self.histograms[name].observe(elapsed)
+        self.frame[name] += elapsed - children
+
+    def timed(self, name):
+        """Decorator recording the latency of each call under name."""
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return f(*args, **kwargs)
+                start = self.start()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.stop(name, start)
+            return wrapper
+        return decorator
+
+    def end_frame(self, tick):
+        """Close off the current frame's per-subsystem breakdown."""
+        self.last_frame = dict(self.frame)
+        self.frame.clear()
+        if self.sampling:
+            self.samples.append((tick, self.last_frame))
+
+    def dump(self, fname):
+        with open(fname, 'w') as f:
+            json.dump({
+                'counters': dict((k, c.count) for k, c
+                                 in self.counters.iteritems()),
+                'gauges': dict((k, g.value) for k, g
+                               in self.gauges.iteritems()),
+                'histograms': dict((k, h.summary()) for k, h
+                                   in self.histograms.iteritems()),
+                'samples': list(self.samples)
+            }, f, indent=2, sort_keys=True)
+
+
+# the process-wide registry.
+metrics = Metrics()
@@ -0,0 +1,96 @@
+"""A world of zones, one process each. Run with `python -m pyquest.world`.
+
+Zones sit in a grid and are joined at their edges by pipes; spawns that
+walk off an edge are handed to the neighboring zone's process.
+"""
+from __future__ import division
+import argparse
+import time
+from multiprocessing import Pipe, Process, Queue
+
+from pyquest.engine import GameLoop
+from pyquest.headless import NullChat, NullScreen
+from pyquest.spawn import Mob
+from pyquest.terrain import fill
+from pyquest.util import metrics
+from pyquest.zone import Zone
+
+
+def zone_process(index, size, mobs, seed, links, ticks, results):
+    """Run one zone for ticks ticks, as fast as it will go."""
+    metrics.enabled = True
+    loop = GameLoop()
+    chat = NullChat()
+    zone = Zone(size, size, NullScreen())
+    # there are no players to wake anything up.
+    zone.lod = False
+    fill(zone, seed=seed + index)
+    for edge, conn in links.items():
+        zone.connect(edge, conn, chat, loop)
+
+    y = x = 0
+    for i in xrange(mobs):
+        while zone.is_occupied(y, x):
+            x = (x + 7) % size
+            y = (y + (x < 7)) % size
+        mob = Mob(y, x, str(i % 10), chat, loop)
+        # let them roam far enough to cross into other zones.
+        mob.wander_radius = size * 4
+        zone.add_spawn(mob)
+
+    loop.repeat(zone.tick)
+    start = time.time()
+    for i in xrange(ticks):
+        loop.step()
+    elapsed = time.time() - start
+
+    handoffs = metrics.histogram('zone.handoff')
+    results.put((index, {
+        'ticks_per_sec': ticks / elapsed,
+        'spawns': len(zone.spawns),
+        'handoffs_in': handoffs.count,
+        'handoff_ms_mean': handoffs.summary()['mean'] * 1000,
+        'handoff_ms_max': handoffs.max * 1000
+    }))
+
+
+def run_world(rows, cols, size=60, mobs=100, ticks=3000, seed=1):
+    """Per-zone stats from running a rows x cols world of zones."""
+    links = [{} for i in xrange(rows * cols)]
+    for r in xrange(rows):
+        for c in xrange(cols):
+            i = r * cols + c
+            if c + 1 < cols:
+                links[i]['right'], links[i + 1]['left'] = Pipe()
+            if r + 1 < rows:
+                links[i]['down'], links[i + cols]['up'] = Pipe()
+
+    results = Queue()
+    procs = [Process(target=zone_process,
+                     args=(i, size, mobs, seed, links[i], ticks, results))
+             for i in xrange(rows * cols)]
+    for proc in procs:
+        proc.start()
+    stats = dict(results.get() for proc in procs)
+    for proc in procs:
+        proc.join()
+    return [stats[i] for i in xrange(rows * cols)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2)
+    parser.add_argument('--cols', type=int, default=2)
+    parser.add_argument('--size', type=int, default=60)
+    parser.add_argument('--mobs', type=int, default=100)
+    parser.add_argument('--ticks', type=int, default=3000)
+    args = parser.parse_args()
+
+    for i, stats in enumerate(run_world(args.rows, args.cols, args.size,
+                                        args.mobs, args.ticks)):
+        print "zone %d: %s" % (i, ' '.join(
+            '%s=%.2f' % item for item in sorted(stats.items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,77 +1,462 @@
+import heapq
 import math
 import logging
+import struct
+import time
+from array import array
+from collections import defaultdict
 
-from pyquest.spawn import Spawn
+import numpy as np
+
+from pyquest.flow import FlowFields
+from pyquest.serial import pack_spawn, unpack_spawn
+from pyquest.fov import FOVCache
+from pyquest.paths import PathGraph
+from pyquest.spatial import SpatialHash
+from pyquest.spawn import AGGRO_RADIUS, Spawn
+from pyquest.stats import StatTable
+from pyquest.util import Bitset, SparseBitset, SparseLayer, metrics
+
+
+# how far around a spawn chunked terrain is kept loaded.
+TERRAIN_RADIUS = 20
+
+# default number of cells route() may expand before giving up.
+ROUTE_BUDGET = 1000
+
+EDGES = ('up', 'right', 'down', 'left')
+OPPOSITE = {'up': 'down', 'down': 'up', 'left': 'right', 'right': 'left'}
+
+# spawns within ACTIVE_RADIUS of a user update every tick, those within
+# IDLE_RADIUS every IDLE_EVERY ticks, and the rest sleep. Tiers are
+# reassigned every TIER_INTERVAL ticks; ACTIVE_RADIUS is far enough past
+# what a user can see that nothing on screen is ever throttled.
+ACTIVE_RADIUS = 30
+IDLE_RADIUS = 60
+IDLE_EVERY = 4
+TIER_INTERVAL = 15
+
+# dead spawns respawn together, on ticks that are multiples of this.
+RESPAWN_BATCH = 30
+
+# edge crossed (index into EDGES), position along it, time sent.
+HANDOFF = struct.Struct('!Bid')
 
 
 class Zone(object):
-    """Keeps track of what's on the field. Does collision detection, etc."""
+    """Keeps track of what's on the field. Does collision detection, etc.
 
-    def __init__(self, y, x, screen):
+    The field is held in flat, row-major layers: a byte per cell of
+    terrain (0 for none), an occupancy bit per cell and a spawn id per
+    cell (0 for none) indexing into spawn_table. Chunked zones keep
+    sparse layers instead, holding only the cells that are set.
+    """
+
+    def __init__(self, y, x, screen, terrain=None):
         self.y = y
         self.x = x
         self.screen = screen
 
-        self.field = []
-        for i in xrange(y):
-            row = []
-            for j in xrange(x):
-                row.append(None)
-            self.field.append(row)
+        # optional ChunkProvider supplying terrain on demand, in which case
+        # the terrain layer only holds what's been set explicitly. Chunked
+        # zones can be far bigger than what's ever visited, so their layers
+        # are sparse, keeping memory down to the cells actually set.
+        self.terrain = terrain
+        if terrain is not None:
+            terrain.listeners.append(self._render_chunk)
+            self.terrain_layer = SparseLayer()
+            self.occupied = SparseBitset()
+            self.spawn_layer = SparseLayer()
+        else:
+            cells = y * x
+            self.terrain_layer = bytearray(cells)
+            self.occupied = Bitset(cells)
+            self.spawn_layer = array('I', [0]) * cells
+
+        # spawn_table[id] is the spawn with that id; id 0 is unused.
+        self.spawn_table = [None]
+        self.spawn_ids = {}
+        self._free_ids = []
+
+        # bumped whenever non-spawn contents of the field change.
+        self.terrain_version = 0
+        self.flow = FlowFields(self)
+        self.fov = FOVCache(self)
+        self.paths = PathGraph(self)
 
         # dict of spawns with values as up-to-date coords.
         # TODO: can make this simple function
         self.spawns = {}
+        self.index = SpatialHash()
+        self.uids = {}
+        self.users = set()
+        # numeric state of the spawns here, see Spawn.move_stats().
+        self.stats = StatTable()
+
+        # activity tiers, see _assign_tiers(). With lod off every spawn
+        # updates every tick.
+        self.lod = True
+        self.ticks = 0
+        self.active = []
+        self.idle = []
+        self._tiers_due = 0
 
+        # the pool of dead spawns waiting to respawn, by the tick of the
+        # batch they're due in. see despawn().
+        self.respawns = defaultdict(list)
+
+        # edge -> Connection to the zone across it. see connect().
+        self.neighbors = {}
+        self.handoff_chat = None
+        self.handoff_scheduler = None
+
+    def _spawn_id(self, spawn):
+        sid = self.spawn_ids.get(spawn)
+        if sid is None:
+            if self._free_ids:
+                sid = self._free_ids.pop()
+                self.spawn_table[sid] = spawn
+            else:
+                sid = len(self.spawn_table)
+                self.spawn_table.append(spawn)
+            self.spawn_ids[spawn] = sid
+        return sid
+
+    def _release_id(self, spawn):
+        sid = self.spawn_ids.pop(spawn, None)
+        if sid is not None:
+            self.spawn_table[sid] = None
+            self._free_ids.append(sid)
 
     def set_field(self, y, x, obj):
-        self.field[y][x] = obj
+        i = y * self.x + x
+        if isinstance(obj, Spawn):
+            self.spawn_layer[i] = self._spawn_id(obj)
+        else:
+            self.terrain_layer[i] = ord(obj[0])
+            self.terrain_version += 1
+            self.paths.invalidate(y, x)
+        self.occupied.set(i)
         self.screen.update(y, x, obj)
 
     def unset_field(self, y, x):
-        cur = self.field[y][x]
-        self.field[y][x] = None
-        self.screen.update(y, x, ' ')
+        i = y * self.x + x
+        if self.spawn_layer[i]:
+            self.spawn_layer[i] = 0
+        elif self.terrain_layer[i]:
+            self.terrain_layer[i] = 0
+            self.terrain_version += 1
+            self.paths.invalidate(y, x)
+        if not self.terrain_layer[i]:
+            self.occupied.clear(i)
+        self.screen.update(y, x, self.get_field(y, x) or ' ')
 
     def get_field(self, y, x):
-        return self.field[y][x]
+        if not self.in_bounds(y, x):
+            return None
+        i = y * self.x + x
+        sid = self.spawn_layer[i]
+        if sid:
+            return self.spawn_table[sid]
+        t = self.terrain_layer[i]
+        if t:
+            return chr(t)
+        if self.terrain is not None:
+            return self.terrain.get(y, x)
+        return None
+
+    def in_bounds(self, y, x):
+        return 0 <= y < self.y and 0 <= x < self.x
+
+    def _touch_terrain(self, y, x):
+        """Load the terrain around a spawn before anything looks at it."""
+        if self.terrain is not None:
+            self.terrain.touch(y, x, TERRAIN_RADIUS)
+
+    def _render_chunk(self, oy, ox, tile):
+        """Draw a freshly loaded terrain tile."""
+        for y, x in zip(*(tile > 0.25).nonzero()):
+            y = oy + int(y)
+            x = ox + int(x)
+            if self.in_bounds(y, x) and not self.has_spawn(y, x):
+                self.screen.update(y, x, '=')
 
     def add_spawn(self, spawn):
         """Should immediately render spawn on map."""
         spawn.set_zone(self)
         self.spawns[spawn] = (spawn.y, spawn.x)
+        self.uids[spawn.uid] = spawn
+        if spawn.is_user():
+            self.users.add(spawn)
+        self.index.insert(spawn, spawn.y, spawn.x)
+        self._adopt(spawn)
+        self._tiers_due = self.ticks
         self.set_field(spawn.y, spawn.x, spawn)
+        self._touch_terrain(spawn.y, spawn.x)
+        self._sense(spawn, None, (spawn.y, spawn.x))
 
     def move_spawn(self, spawn, y, x):
-        if self.is_occupied(y, x):
-            return
-        if x < 0 or x >= self.x:
+        if not self.in_bounds(y, x):
+            edge = self._edge(y, x)
+            if edge in self.neighbors:
+                along = x if edge in ('up', 'down') else y
+                self.hand_off(spawn, edge, along)
             return
-        if y < 0 or y >= self.y:
+        if self.is_occupied(y, x):
             return
 
+        old = (spawn.y, spawn.x)
         self.unset_field(spawn.y, spawn.x)
         spawn.y = y
         spawn.x = x
+        self.spawns[spawn] = (y, x)
+        self.index.move(spawn, y, x)
         self.set_field(y, x, spawn)
+        self._touch_terrain(y, x)
+        self._sense(spawn, old, (y, x))
+
+    def _adopt(self, spawn):
+        """Take spawn's stats into the zone's table, to regenerate every
+        regenerate_delay ticks from now."""
+        stats = self.stats
+        row = spawn.move_stats(stats)
+        stats.active[row] = True
+        stats.regen_delay[row] = spawn.regenerate_delay
+        stats.regen_next[row] = self.ticks + spawn.regenerate_delay
 
-    def remove_spawn(self, spawn):
+    def remove_spawn(self, spawn, pool=False):
+        """Take spawn out of the zone.
+
+        Its stats go with it, unless pool is set, when its row of the
+        zone's table is kept (inactive) for it to respawn into. Anything it
+        had scheduled is cancelled, so nothing it queued before leaving can
+        put it back, and its zone is cleared.
+        """
         if spawn in self.spawns:
+            self._sense(spawn, (spawn.y, spawn.x), None)
             del self.spawns[spawn]
+        self.uids.pop(spawn.uid, None)
+        self.users.discard(spawn)
+        self.index.remove(spawn)
+        self.flow.discard(spawn)
         self.unset_field(spawn.y, spawn.x)
+        self._release_id(spawn)
+        if spawn.stats is self.stats:
+            self.stats.active[spawn.stats_row] = False
+            if not pool:
+                spawn.move_stats(StatTable(1))
+        spawn.cancel_actions()
+        spawn.set_zone(None)
+
+    def despawn(self, spawn):
+        """Take a dead spawn out, pooling it to respawn if spawn.respawn.
+
+        Pooled spawns keep their stats row, and are reset and added back
+        at their spawn point in the first batch after their respawn delay,
+        so no new objects or scheduler jobs are made however often things
+        die.
+        """
+        self.remove_spawn(spawn, pool=spawn.respawn is not None)
+        if spawn.respawn is None:
+            return
+        due = self.ticks + spawn.respawn
+        self.respawns[due + -due % RESPAWN_BATCH].append(spawn)
+
+    def _respawn(self):
+        batch = self.respawns.pop(self.ticks, None)
+        if batch is None:
+            return
+        for spawn in batch:
+            spawn.reset()
+            if self.is_occupied(spawn.y, spawn.x):
+                # something's standing there; try again next batch.
+                self.respawns[self.ticks + RESPAWN_BATCH].append(spawn)
+                continue
+            self.add_spawn(spawn)
+            metrics.counter('zone.respawns').inc()
+
+    def _sense(self, spawn, old, new):
+        """Raise the proximity triggers spawn moving from old to new sets off.
+
+        old is None for a spawn arriving, new for one leaving. Mobs hating
+        spawn re-base their hate for it, and mobs watching for users hear
+        of each one entering, moving within or leaving their aggro radius.
+        """
+        for mob in list(spawn.haters):
+            if new is None:
+                mob.hate.forget(spawn)
+            else:
+                mob.hate.rebase(spawn)
+        if new is None:
+            spawn.removed()
+        else:
+            spawn.moved()
+
+        is_user = spawn.is_user()
+        if not is_user and not spawn.aggro_radius:
+            return
+
+        near = set()
+        for pos in (old, new):
+            if pos is not None:
+                near.update(self.index.in_radius(pos[0], pos[1],
+                                                 AGGRO_RADIUS))
+        near.discard(spawn)
+        for other in near:
+            watcher, user = (other, spawn) if is_user else (spawn, other)
+            r = watcher.aggro_radius
+            if not r or not user.is_user():
+                continue
+            was = old is not None and \
+                self.distance(old[0], old[1], other.y, other.x) <= r
+            inside = new is not None and \
+                self.distance(new[0], new[1], other.y, other.x) <= r
+            if was or inside:
+                watcher.sense(user, inside)
+
+    def _edge(self, y, x):
+        if y < 0:
+            return 'up'
+        if y >= self.y:
+            return 'down'
+        if x < 0:
+            return 'left'
+        return 'right'
+
+    def connect(self, edge, conn, chat, scheduler):
+        """Pass spawns crossing edge to the zone at the other end of conn.
+
+        conn is a multiprocessing Connection. Spawns arriving over it are
+        bound to chat and scheduler.
+        """
+        self.neighbors[edge] = conn
+        self.handoff_chat = chat
+        self.handoff_scheduler = scheduler
+
+    def hand_off(self, spawn, edge, along):
+        """Move spawn out through edge into the neighboring zone."""
+        data = HANDOFF.pack(EDGES.index(edge), along, time.time()) + \
+            pack_spawn(spawn)
+        self.remove_spawn(spawn)
+        self.neighbors[edge].send_bytes(data)
+
+    def receive_handoffs(self):
+        """Take in any spawns neighboring zones have handed over."""
+        for conn in self.neighbors.values():
+            while conn.poll():
+                data = conn.recv_bytes()
+                edge, along, sent = HANDOFF.unpack_from(data)
+                spawn = unpack_spawn(data[HANDOFF.size:], self.handoff_chat,
+                                     self.handoff_scheduler, self.uids.get)
+                cell = self._entry_cell(OPPOSITE[EDGES[edge]], along)
+                if cell is None:
+                    logging.warning("no room for spawn %x" % spawn.uid)
+                    continue
+                spawn.y, spawn.x = cell
+                self.add_spawn(spawn)
+                metrics.histogram('zone.handoff').observe(time.time() - sent)
+
+    def _entry_cell(self, edge, along):
+        """Free cell nearest position along on edge, working inwards."""
+        size = self.x if edge in ('up', 'down') else self.y
+        depth = self.y if edge in ('up', 'down') else self.x
+        along = min(max(along, 0), size - 1)
+        for inward in xrange(depth):
+            for offset in xrange(size):
+                for a in (along - offset, along + offset):
+                    if not 0 <= a < size:
+                        continue
+                    if edge == 'up':
+                        cell = (inward, a)
+                    elif edge == 'down':
+                        cell = (self.y - 1 - inward, a)
+                    elif edge == 'left':
+                        cell = (a, inward)
+                    else:
+                        cell = (a, self.x - 1 - inward)
+                    if not self.is_occupied(*cell):
+                        return cell
+        return None
 
     def is_occupied(self, y, x):
-        return bool(self.field[y][x])
+        if self.occupied.test(y * self.x + x):
+            return True
+        return self.terrain is not None and self.terrain.get(y, x) is not None
     
     def has_spawn(self, y, x):
-        return isinstance(self.field[y][x], Spawn)
+        return self.in_bounds(y, x) and bool(self.spawn_layer[y * self.x + x])
+
+    def is_blocked(self, y, x):
+        """Occupied by something other than a spawn."""
+        if self.terrain_layer[y * self.x + x]:
+            return True
+        return self.terrain is not None and self.terrain.get(y, x) is not None
+
+    def blocked_area(self, y0, x0, y1, x1):
+        """Array of is_blocked() for rows y0:y1 and columns x0:x1, read a
+        tile at a time rather than a cell at a time."""
+        layer = self.terrain_layer
+        if self.terrain is None:
+            field = np.frombuffer(layer, dtype=np.uint8).reshape(self.y, self.x)
+            return field[y0:y1, x0:x1] != 0
 
+        blocked = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        size = self.terrain.size
+        for cy in xrange(y0 // size, (y1 - 1) // size + 1):
+            for cx in xrange(x0 // size, (x1 - 1) // size + 1):
+                tile = self.terrain.chunk(cy, cx)
+                ty0, tx0 = max(y0, cy * size), max(x0, cx * size)
+                ty1, tx1 = min(y1, (cy + 1) * size), min(x1, (cx + 1) * size)
+                blocked[ty0 - y0:ty1 - y0, tx0 - x0:tx1 - x0] = \
+                    tile[ty0 - cy * size:ty1 - cy * size,
+                         tx0 - cx * size:tx1 - cx * size] > 0.25
+        if layer:
+            for y in xrange(y0, y1):
+                for x in xrange(x0, x1):
+                    if layer[y * self.x + x]:
+                        blocked[y - y0, x - x0] = True
+        return blocked
+
+    def spawns_in_radius(self, y, x, r, exclude=None):
+        """Spawns within distance r of (y, x), other than exclude."""
+        return [spawn for spawn in self.index.in_radius(y, x, r)
+                if spawn is not exclude]
+
+    def nearest_spawns(self, y, x, k=1, radius=None, accept=None):
+        """Up to k spawns nearest (y, x), closest first."""
+        return [spawn for _, spawn
+                in self.index.nearest(y, x, k, radius, accept)]
+
+    def visible(self, y, x, radius):
+        """Cells that can be seen from (y, x), terrain blocking sight."""
+        return self.fov.visible(y, x, radius)
 
     def cell_iter(self):
         for y in xrange(self.y):
             for x in xrange(self.x):
                 yield (y, x)
 
+    def terrain_iter(self):
+        """(y, x, cell) for each cell of terrain set explicitly or in a
+        loaded tile, without generating any more."""
+        if self.terrain is not None:
+            size = self.terrain.size
+            for (cy, cx), tile in self.terrain.tiles.items():
+                for y, x in zip(*(tile > 0.25).nonzero()):
+                    y = cy * size + int(y)
+                    x = cx * size + int(x)
+                    if self.in_bounds(y, x):
+                        yield (y, x, '=')
+
+        layer = self.terrain_layer
+        if isinstance(layer, SparseLayer):
+            cells = layer.keys()
+        else:
+            cells = np.flatnonzero(np.frombuffer(layer, dtype=np.uint8))
+        for i in cells:
+            y, x = divmod(int(i), self.x)
+            yield (y, x, chr(layer[i]))
+
     def circle_iter(self, center_y, center_x, r):
         """
         Iterator of coords in circle of r radius around self.
@@ -86,56 +471,63 @@ class Zone(object):
     def neighbor_iter(self, y, x):
         if y > 0:
             yield (y - 1, x)
-        if x < self.x:
+        if x < self.x - 1:
             yield (y, x + 1)
-        if y < self.y:
+        if y < self.y - 1:
             yield (y + 1, x)
         if x > 0:
             yield (y, x - 1)
 
+    @metrics.timed('zone.route')
+    def route(self, y1, x1, y2, x2, budget=ROUTE_BUDGET):
+        """A* from (y1, x1) to (y2, x2) over unoccupied cells.
+
+        Returns the list of cells from start to goal inclusive, or None if
+        there's no route or budget cells were expanded without finding one.
+        The goal itself may be occupied (it's usually the target).
+        """
+        start = (y1, x1)
+        goal = (y2, x2)
 
-    def route(self, y1, x1, y2, x2):
-        logging.info("routing")
-        dist = {}
-        previous = {}
-        q = set()
+        def h(node):
+            # moves are cardinal only, so manhattan distance is admissible.
+            return abs(node[0] - y2) + abs(node[1] - x2)
 
-        def add_node(node):
-            dist[node] = 'inf'
-            previous[node] = None
-            q.add(node)
+        g = {start: 0}
+        previous = {start: None}
+        # (f, tiebreak, node). tiebreak keeps the heap off comparing nodes
+        # and prefers the most recently pushed of equal f.
+        heap = [(h(start), 0, start)]
+        counter = 0
+        closed = set()
 
-        for node in self.circle_iter(y1, x1, 10):
-            if self.is_occupied(node[0], node[1]):
+        while heap and len(closed) < budget:
+            _, _, node = heapq.heappop(heap)
+            if node == goal:
+                path = []
+                while node is not None:
+                    path.append(node)
+                    node = previous[node]
+                path.reverse()
+                return path
+            if node in closed:
                 continue
-            add_node(node)
-            #self.set_field(node[0], node[1]+10, 'x')
-
-        for node in ((y1, x1), (y2, x2)):
-            add_node(node)
-
-        dist[(y1, x1)] = 0
-        while len(q):
-            node, u = min([item for item in dist.items() if item[0] in q],
-                          key=lambda x: x[1])
-            if u == 'inf':
-                break
-            if node == (y2, x2):
-                s = []
-                u = (y2, x2)
-                while u in previous:
-                    s.insert(0, u)
-                    #self.set_field(u[0], u[1], 'x')
-                    u = previous[u]
-                return s
-            q.remove(node)
-            neighbors = set(self.neighbor_iter(*node)).intersection(q)
-            for v in neighbors:
-                alt = u + self.distance(node[0], node[1], v[0], v[1])
-                if alt < dist[v]:
-                    dist[v] = alt
+            closed.add(node)
+
+            cost = g[node] + 1
+            for v in self.neighbor_iter(*node):
+                if v in closed:
+                    continue
+                if v != goal and self.is_occupied(*v):
+                    continue
+                if cost < g.get(v, cost + 1):
+                    g[v] = cost
                     previous[v] = node
+                    counter -= 1
+                    heapq.heappush(heap, (cost + h(v), counter, v))
 
+        logging.debug("no route (%d, %d) -> (%d, %d)" % (y1, x1, y2, x2))
+        return None
 
     @staticmethod
     def distance(y1, x1, y2, x2):
@@ -143,7 +535,57 @@ class Zone(object):
         delta_x = abs(x1 - x2)
         return math.sqrt(pow(delta_y, 2) + pow(delta_x, 2))
 
+    def _assign_tiers(self):
+        """Sort spawns into active and idle tiers by nearness to users."""
+        active = set()
+        idle = set()
+        for user in self.users:
+            active.update(self.index.in_radius(user.y, user.x,
+                                               ACTIVE_RADIUS))
+            idle.update(self.index.in_radius(user.y, user.x, IDLE_RADIUS))
+        idle -= active
+        self.active = list(active)
+        self.idle = list(idle)
+        self._tiers_due = self.ticks + TIER_INTERVAL
+
+        metrics.gauge('zone.active').set(len(active))
+        metrics.gauge('zone.idle').set(len(idle))
+        metrics.gauge('zone.asleep').set(
+            len(self.spawns) - len(active) - len(idle))
+
+    @metrics.timed('zone.tick')
     def tick(self):
-        for spawn in self.spawns.keys():
+        """Update live spawns near users, then draw what changed.
+
+        Idle spawns are updated a share at a time, and sleeping ones not
+        at all. Every spawn's regeneration is done in one pass over the
+        stats table, whatever its tier.
+        """
+        if self.neighbors:
+            self.receive_handoffs()
+
+        self.ticks += 1
+        self.stats.regenerate(self.ticks)
+        if self.respawns and self.ticks % RESPAWN_BATCH == 0:
+            self._respawn()
+
+        spawns = self.spawns
+        if not self.lod:
+            due = spawns.keys()
+        else:
+            if self.ticks >= self._tiers_due:
+                self._assign_tiers()
+            due = self.active + \
+                self.idle[self.ticks % IDLE_EVERY::IDLE_EVERY]
+
+        alive = self.stats.alive()
+        for spawn in due:
+            # an earlier spawn's update may have killed this one, in which
+            # case it's no longer in spawns.
+            if spawn in spawns and alive[spawn.stats_row]:
+                spawn.update()
 
-            self.screen.update(spawn.y, spawn.x, spawn)
+        if self.screen.colors_stale():
+            for spawn in self.spawns:
+                self.screen.update(spawn.y, spawn.x, spawn)
+        self.screen.flush()